@@ -2,22 +2,26 @@ import cv2
 import os
 import time
 import json
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression
-import matplotlib.path as mplPath
-import matplotlib.patches as patches
-from ultralyticsplus import YOLO
-from scripts.test_filtered_cls import load, load_model, process
+# matplotlib, sklearn, ultralyticsplus, torch and albumentations are imported by the functions using them,
+# so that importing the module for the model-free stages (assess_frame) or a short-lived worker stays fast
 
 PATH_jpgs = 'RailNet_DT/assets/rs19val/jpgs/test'
 PATH_model_seg = 'RailNet_DT/assets/models_pretrained/segformer/SegFormer_B3_1024_finetuned.pth'
 PATH_model_det = 'RailNet_DT/assets/models_pretrained/ultralyticsplus/yolov8s'
 PATH_base = 'RailNet_DT/assets/pilsen_railway_dataset/'
 eda_path = "RailNet_DT/assets/pilsen_railway_dataset/eda_table.table.json"
-data_json = json.load(open(eda_path, 'r'))
+
+@functools.lru_cache(maxsize=None)
+def load_eda_table(eda_path=eda_path):
+        # Pilsen dataset metadata, parsed on the first use only
+        with open(eda_path, 'r') as eda_file:
+                return json.load(eda_file)
 
 def load_yolo(PATH_model):
+        from ultralyticsplus import YOLO
+        
         model = YOLO(PATH_model)
 
         model.overrides['conf'] = 0.25  # NMS confidence threshold
@@ -453,6 +457,8 @@ def extrapolate_line(pixels, image, min_y=None, extr_pixels=10):
                 print("Not enough pixels to perform extrapolation.")
                 return []
 
+        from sklearn.linear_model import LinearRegression
+        
         recent_pixels = np.array(pixels[-extr_pixels:])
         
         X = recent_pixels[:, 0].reshape(-1, 1)  # Reshape for sklearn
@@ -561,11 +567,29 @@ def border_handler(id_map, image, edges, target_distances):
         return borders, id_map, regions
 
 def segment(model_seg, image_size, filename, PATH_jpgs, dataset_type, model_type, item=None):
+        from scripts.test_filtered_cls import load, process
+        
         image_norm, _, image, mask, _ = load(filename, PATH_jpgs, image_size, dataset_type=dataset_type, item=item)
         id_map = process(model_seg, image_norm, mask, model_type)
         id_map = cv2.resize(id_map, [1920,1080], interpolation=cv2.INTER_NEAREST)
         return id_map, image
 
+def segment_batch(model_seg, image_size, images, model_type):
+        """
+        Segment a batch of already decoded frames with a single forward pass.
+        
+        Parameters:
+        - images: List of BGR frames as returned by cv2.imread.
+        
+        Returns:
+        A list of full HD id maps in the order of the input frames.
+        """
+        from scripts.test_filtered_cls import preprocess_batch, process_batch
+        
+        images_norm = preprocess_batch(images, image_size)
+        id_maps = process_batch(model_seg, images_norm, image_size, model_type)
+        return [cv2.resize(id_map, [1920,1080], interpolation=cv2.INTER_NEAREST) for id_map in id_maps]
+
 def detect(model_det, filename_img, PATH_jpgs):
         
         image = cv2.imread(os.path.join(PATH_jpgs, filename_img))
@@ -573,6 +597,10 @@ def detect(model_det, filename_img, PATH_jpgs):
 
         return results, model_det, image
 
+def detect_batch(model_det, images):
+        results = model_det.predict(images)
+        return [[result] for result in results]
+
 def manage_detections(results, model):
         bbox = results[0].boxes.xywh.tolist()
         cls = results[0].boxes.cls.tolist()
@@ -696,6 +724,8 @@ def get_bounding_box_points(cx, cy, w, h):
         return points
 
 def classify_detections(boxes_moving, boxes_stationary, borders, img_dims, output_dims=[1080,1920]):
+        import matplotlib.path as mplPath
+        
         img_h, img_w, _ = img_dims
         img_h_scaletofullHD = output_dims[1]/img_w
         img_w_scaletofullHD = output_dims[0]/img_h
@@ -795,6 +825,9 @@ def draw_classification(classification, id_map):
                 return
 
 def show_result(classification, id_map, names, borders, image, regions, file_index):
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as patches
+        
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
         image = cv2.resize(image, (id_map.shape[1], id_map.shape[0]), interpolation = cv2.INTER_LINEAR)
         ratio = image.shape[0] / image.shape[1]
@@ -848,11 +881,18 @@ def show_result(classification, id_map, names, borders, image, regions, file_ind
         #plt.close()
         print('Frame processed successfully.')
 
-def run(model_seg, model_det, image_size, filepath_img, PATH_jpgs, dataset_type, model_type, target_distances, file_index, vis, item=None, num_ys = 15):
-
-        segmentation_mask, image = segment(model_seg, image_size, filepath_img, PATH_jpgs, dataset_type, model_type, item)
-        print('File: {}'.format(filepath_img))
+def assess_frame(segmentation_mask, image, results, model_det, target_distances, num_ys = 15):
+        """
+        Model-free part of the pipeline: border search on the segmentation and classification of the detections.
+        
+        Parameters:
+        - segmentation_mask: Full HD id map returned by segment.
+        - image: The decoded input frame.
+        - results: Detector results of the frame (ultralytics-like, results[0].boxes).
         
+        Returns:
+        A tuple (classification, borders, id_map, regions).
+        """
         # Border search
         clues = get_clues(segmentation_mask, num_ys)
         #edges = find_edges(segmentation_mask, clues, min_width=int(segmentation_mask.shape[1]*0.02))
@@ -861,11 +901,41 @@ def run(model_seg, model_det, image_size, filepath_img, PATH_jpgs, dataset_type,
         
         borders, id_map, regions = border_handler(segmentation_mask, image, edges, target_distances)
         
+        boxes_moving, boxes_stationary = manage_detections(results, model_det)
+        
+        classification = classify_detections(boxes_moving, boxes_stationary, borders, image.shape, output_dims=segmentation_mask.shape)
+        
+        return classification, borders, id_map, regions
+
+def format_classification(classification, names, target_distances):
+        """
+        Converts the classification of classify_detections into JSON serializable records.
+        
+        Returns:
+        A dict with the target distances and a list of dicts, one per accepted detection.
+        """
+        records = []
+        for item, criticality, color, center, size, moving in classification or []:
+                records.append({
+                        "class_id": int(item),
+                        "name": names[int(item)],
+                        "criticality": int(criticality), # index of the zone, -1 outside of all zones
+                        "color": color,
+                        "center": [float(center[0]), float(center[1])],
+                        "size": [float(size[0]), float(size[1])],
+                        "moving": bool(moving),
+                })
+        return {"target_distances": target_distances, "detections": records}
+
+def run(model_seg, model_det, image_size, filepath_img, PATH_jpgs, dataset_type, model_type, target_distances, file_index, vis, item=None, num_ys = 15):
+
+        segmentation_mask, image = segment(model_seg, image_size, filepath_img, PATH_jpgs, dataset_type, model_type, item)
+        print('File: {}'.format(filepath_img))
+        
         # Detection
         results, model, image = detect(model_det, filepath_img, PATH_jpgs)
-        boxes_moving, boxes_stationary = manage_detections(results, model)
         
-        classification = classify_detections(boxes_moving, boxes_stationary, borders, image.shape, output_dims=segmentation_mask.shape)
+        classification, borders, id_map, regions = assess_frame(segmentation_mask, image, results, model, target_distances, num_ys)
         
         #draw_classification(classification, id_map)
         show_result(classification, id_map, model.names, borders, image, regions, file_index)
@@ -874,21 +944,33 @@ if __name__ == "__main__":
 
         data_type = 'railsem19' #railsem19, pilsen or testdata
         model_type = "segformer" #segformer or deeplab
+        backend = 'torch' #torch, int8 (dynamic INT8 quantization), torchscript, compile or onnx (model exported by export_onnx.py)
+        intra_op_threads, inter_op_threads = 0, 0 # onnx backend threads, 0 = all physical cores
+        num_threads, interop_threads = None, None # torch threads, None = torch defaults
+        cpu_affinity = None # cores to pin the process to, e.g. range(0, 16)
         vis = False
         image_size = [1024,1024]
         target_distances = [650,1000,2000] #[600,1000,2000] [4000,5500,6500] [2000,3000,4000]
         num_ys = 10
         
+        from scripts.test_filtered_cls import load_model
+        from scripts.inference_context import configure_inference
+        
+        configure_inference(num_threads, interop_threads, cpu_affinity)
+        
+        if backend == 'onnx':
+                PATH_model_seg = os.path.splitext(PATH_model_seg)[0] + '.onnx' # '_int8_static.onnx' for the INT8 model by quantize_model.py
+        
         if data_type == 'pilsen':
                 file_index = 0
-                model_seg = load_model(PATH_model_seg)
+                model_seg = load_model(PATH_model_seg, backend, intra_op_threads, inter_op_threads, model_type, image_size)
                 model_det = load_yolo(PATH_model_det)
-                for item in enumerate(data_json["data"]):
+                for item in enumerate(load_eda_table()["data"]):
                         filepath_img = item[1][1]["path"]
                         run(model_seg, model_det, image_size, filepath_img, PATH_base, data_type, model_type, target_distances, file_index, vis=vis, item=item, num_ys=num_ys)
         elif data_type == 'railsem19':
                 file_index = 0
-                model_seg = load_model(PATH_model_seg)
+                model_seg = load_model(PATH_model_seg, backend, intra_op_threads, inter_op_threads, model_type, image_size)
                 model_det = load_yolo(PATH_model_det)
                 for filename_img in os.listdir(PATH_jpgs):
                         #filename_img = "rs07650.jpg"
@@ -897,7 +979,7 @@ if __name__ == "__main__":
         else:
                 file_index = 0
                 PATH_jpgs = 'Grafika/Video_export/frames'
-                model_seg = load_model(PATH_model_seg)
+                model_seg = load_model(PATH_model_seg, backend, intra_op_threads, inter_op_threads, model_type, image_size)
                 model_det = load_yolo(PATH_model_det)
                 for filename_img in os.listdir(PATH_jpgs):
                         if os.path.exists(os.path.join('Grafika/Video_export/frames_estimated', filename_img)):
@@ -0,0 +1,46 @@
+import os
+import time
+import json
+import torch
+from scripts.dataloader_RailSem19 import CustomDataset
+from scripts.data_loading import create_dataloader, benchmark_loader
+
+PATH_JPGS = "RailNet_DT/rs19_val_light/jpgs/rs19_val"
+PATH_MASKS = "RailNet_DT/rs19_val_light/uint8/rs19_val"
+PATH_CACHE = None # pre-decoded Valid subset written by scripts/dataset_cache.py, used with subset = 'Valid'
+PATH_LOGS = 'RailNet_DT/logs'
+
+if __name__ == "__main__":
+    image_size = [1024,1024]
+    batch_size = 8
+    num_batches = 20
+    subset = 'Train' # Train runs the whole augmentation chain, Valid only the resize
+    settings = [
+        {"num_workers": 0},
+        {"num_workers": 2, "persistent_workers": True, "pin_memory": True, "prefetch_factor": 2},
+        {"num_workers": 4, "persistent_workers": True, "pin_memory": True, "prefetch_factor": 2},
+        {"num_workers": 8, "persistent_workers": True, "pin_memory": True, "prefetch_factor": 4},
+    ]
+    save_results = True
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    dataset = CustomDataset(PATH_JPGS, PATH_MASKS, image_size, subset=subset, val_fraction=0.5, cache_dir=PATH_CACHE)
+
+    results = []
+    for setting in settings:
+        dataloader = create_dataloader(dataset, batch_size, shuffle=True, drop_last=True, **setting)
+        result = benchmark_loader(dataloader, num_batches, device)
+        del dataloader # stops the persistent workers before the next setting
+
+        result.update(setting, subset=subset, batch_size=batch_size, cache=dataset.cache is not None)
+        print('workers: {:2d} | prefetch: {} | pin memory: {:5} | first batch: {:>6} s | {:7.2f} samples/s | {:6.2f} batches/s'.format(
+            setting["num_workers"], setting.get("prefetch_factor", '-'), str(setting.get("pin_memory", False)),
+            '-' if result["first_batch_s"] is None else '{:.2f}'.format(result["first_batch_s"]), result["samples_per_s"], result["batches_per_s"]))
+        results.append(result)
+
+    if save_results:
+        os.makedirs(PATH_LOGS, exist_ok=True)
+        with open(os.path.join(PATH_LOGS, 'benchmark_loader.jsonl'), 'a') as log_file:
+            for result in results:
+                result["timestamp"] = time.strftime('%Y-%m-%d %H:%M:%S')
+                log_file.write(json.dumps(result) + '\n')
@@ -0,0 +1,140 @@
+import os
+import time
+import json
+import sys
+import resource
+import subprocess
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+from scripts.inference_context import inference_context
+from scripts.stub_models import create_stub_segformer, create_tiny_segformer, StubDetector, create_tiny_yolo, TimedModel
+
+PATH_jpgs = 'RailNet_DT/assets/rs19val/jpgs/test'
+PATH_LOGS = 'RailNet_DT/logs'
+
+def load_frames(PATH_jpgs, num_frames):
+    filenames = sorted(f for f in os.listdir(PATH_jpgs) if f.endswith(('.jpg', '.png')))
+    images = [cv2.imread(os.path.join(PATH_jpgs, f)) for f in filenames]
+    return [images[i % len(images)] for i in range(num_frames)]
+
+def create_models(segmenter, detector, outs=13):
+    if segmenter == 'stub':
+        model_seg = create_stub_segformer(outs)
+    elif segmenter == 'tiny':
+        model_seg = create_tiny_segformer(outs)
+
+    if detector == 'stub':
+        model_det = StubDetector()
+    elif detector == 'tiny':
+        model_det = create_tiny_yolo()
+
+    return TimedModel(model_seg), TimedModel(model_det)
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def benchmark_config(segmenter, detector, batch_size, num_threads, image_size, num_frames, warmup, target_distances, num_ys):
+    """
+    Runs the whole pipeline (segmentation, detection, border search and classification) on stand-in models.
+    Executed in a fresh process for every configuration, so that the peak RSS belongs to the configuration only.
+
+    Returns:
+    A dict with the throughput, the latency percentiles, the time split between the models and the pipeline and the peak RSS.
+    """
+    from TheDistanceAssessor import segment_batch, detect_batch, assess_frame
+
+    model_seg, model_det = create_models(segmenter, detector)
+    frames = load_frames(PATH_jpgs, num_frames + warmup*batch_size)
+
+    latencies = []
+    start = None
+    with inference_context(num_threads=num_threads):
+        for i in range(0, len(frames), batch_size):
+            if i == warmup*batch_size:
+                model_seg.elapsed, model_det.elapsed = 0.0, 0.0
+                start = time.perf_counter()
+
+            batch = frames[i:i+batch_size]
+            batch_start = time.perf_counter()
+            id_maps = segment_batch(model_seg, image_size, batch, 'segformer')
+            results = detect_batch(model_det, batch)
+            for id_map, image, result in zip(id_maps, batch, results):
+                assess_frame(id_map, image, result, model_det, target_distances, num_ys)
+
+            # every frame of the batch is finished only when the whole batch is
+            latencies.extend([time.perf_counter() - batch_start] * len(batch))
+
+    total = time.perf_counter() - start
+    latencies = np.array(latencies[warmup*batch_size:]) * 1000
+
+    return {
+        "segmenter": segmenter,
+        "detector": detector,
+        "batch_size": batch_size,
+        "num_threads": num_threads,
+        "frames": len(latencies),
+        "fps": len(latencies) / total,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p90_ms": float(np.percentile(latencies, 90)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "segmentation_ms": model_seg.elapsed / len(latencies) * 1000,
+        "detection_ms": model_det.elapsed / len(latencies) * 1000,
+        "pipeline_overhead_ms": (total - model_seg.elapsed - model_det.elapsed) / len(latencies) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def measure_startup(module='TheDistanceAssessor', repeats=5, heavy_modules=['torch','matplotlib','sklearn','ultralyticsplus','albumentations','rs19_val']):
+    """
+    Measures the import of a module in fresh interpreters (what a short-lived worker or a test run pays before the first frame).
+
+    Returns:
+    The median import time in ms and the heavy modules loaded by the import.
+    """
+    script = 'import sys, time; start = time.perf_counter(); import {}; print(time.perf_counter() - start); print(",".join(m for m in {} if m in sys.modules))'.format(module, heavy_modules)
+    times, loaded = [], ''
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout.splitlines()
+        times.append(float(output[0]) * 1000)
+        loaded = output[1] if len(output) > 1 else ''
+    return float(np.median(times)), [m for m in loaded.split(',') if m]
+
+def run_benchmark(segmenter, detector, batch_sizes, thread_counts, image_size, num_frames=32, warmup=2, target_distances=[650,1000,2000], num_ys=10):
+    results = []
+    for num_threads in thread_counts:
+        for batch_size in batch_sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+                result = executor.submit(benchmark_config, segmenter, detector, batch_size, num_threads, image_size, num_frames, warmup, target_distances, num_ys).result()
+
+            print('seg: {} | det: {} | batch: {:2d} | threads: {:2d} | fps: {:7.2f} | p50: {:8.2f} ms | p90: {:8.2f} ms | p99: {:8.2f} ms | seg: {:7.2f} ms | det: {:7.2f} ms | overhead: {:7.2f} ms | peak RSS: {:7.1f} MB'.format(
+                result["segmenter"], result["detector"], batch_size, num_threads, result["fps"], result["latency_p50_ms"], result["latency_p90_ms"], result["latency_p99_ms"],
+                result["segmentation_ms"], result["detection_ms"], result["pipeline_overhead_ms"], result["peak_rss_mb"]))
+            results.append(result)
+
+    return results
+
+if __name__ == "__main__":
+    segmenter = 'stub' # stub (pipeline overhead only) or tiny (random-weight SegFormer)
+    detector = 'stub' # stub (fixed boxes) or tiny (random-weight yolov8n)
+    batch_sizes = [1,2,4]
+    thread_counts = [1,2,4]
+    image_size = [1024,1024]
+    num_frames = 32
+    startup_budget_ms = 300 # import of TheDistanceAssessor, without the model dependencies
+    save_results = True
+
+    startup_ms, loaded = measure_startup('TheDistanceAssessor')
+    print('startup: {:.1f} ms (budget {} ms) | heavy modules imported: {}'.format(startup_ms, startup_budget_ms, ', '.join(loaded) if loaded else 'none'))
+    if startup_ms > startup_budget_ms or loaded:
+        print('Startup budget exceeded, check the module level imports of TheDistanceAssessor.py (python -X importtime -c "import TheDistanceAssessor").')
+
+    results = run_benchmark(segmenter, detector, batch_sizes, thread_counts, image_size, num_frames)
+
+    if save_results:
+        os.makedirs(PATH_LOGS, exist_ok=True)
+        with open(os.path.join(PATH_LOGS, 'benchmark_pipeline.jsonl'), 'a') as log_file:
+            for result in results:
+                result["timestamp"] = time.strftime('%Y-%m-%d %H:%M:%S')
+                log_file.write(json.dumps(result) + '\n')
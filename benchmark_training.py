@@ -0,0 +1,69 @@
+import os
+import time
+import json
+import functools
+import torch
+import torch.nn as nn
+from scripts.mixed_precision import MixedPrecision, benchmark_training
+
+PATH_LOGS = 'RailNet_DT/logs'
+
+def forward_segformer(model, inputs, masks, criterion):
+    logits = model(inputs).logits
+    upsampled_logits = nn.functional.interpolate(logits, size=masks.shape[-2:], mode="bilinear", align_corners=False)
+    return criterion(upsampled_logits.float(), masks)
+
+def forward_deeplab(model, inputs, masks, criterion):
+    return criterion(torch.squeeze(model(inputs)['out']), masks)
+
+if __name__ == "__main__":
+    model_type = "segformer" #segformer or deeplab
+    image_size = [1024,1024]
+    batch_size = 4
+    outs = 13
+    num_steps = 10
+    settings = [
+        {"precision": 'fp32', "channels_last": False},
+        {"precision": 'fp32', "channels_last": True},
+        {"precision": 'amp', "channels_last": False},
+        {"precision": 'amp', "channels_last": True},
+    ]
+    save_results = True
+
+    if model_type == 'segformer':
+        from train_SegFormer import create_model
+        forward = forward_segformer
+    else:
+        from train_DeepLabv3 import create_model
+        forward = forward_deeplab
+    # benchmark_training calls forward(model, inputs, masks), the loss is bound here
+    forward = functools.partial(forward, criterion=nn.CrossEntropyLoss(ignore_index=255))
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    # a fixed random batch, the loading is measured by benchmark_loader.py
+    inputs = torch.randn(batch_size, 3, image_size[0], image_size[1])
+    masks = torch.randint(0, outs, (batch_size, image_size[0], image_size[1]))
+
+    results = []
+    for setting in settings:
+        # a fresh model per setting, channels_last converts the parameters in place
+        model = create_model(outs)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=0.00006)
+        precision = MixedPrecision(setting["precision"], device, setting["channels_last"])
+        result = benchmark_training(model, forward, optimizer, precision, inputs, masks, num_steps)
+        del model, optimizer
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+        result.update(setting, dtype=str(precision.dtype or torch.float32), model_type=model_type, batch_size=batch_size, image_size=image_size, device=str(device))
+        print('precision: {:4} ({:14}) | channels last: {:5} | {:6.2f} samples/s | step: {:7.1f} ms | peak memory: {} MB'.format(
+            setting["precision"], result["dtype"], str(setting["channels_last"]), result["samples_per_s"], result["step_time_ms"],
+            '-' if result["peak_memory_mb"] is None else '{:.0f}'.format(result["peak_memory_mb"])))
+        results.append(result)
+
+    if save_results:
+        os.makedirs(PATH_LOGS, exist_ok=True)
+        with open(os.path.join(PATH_LOGS, 'benchmark_training.jsonl'), 'a') as log_file:
+            for result in results:
+                result["timestamp"] = time.strftime('%Y-%m-%d %H:%M:%S')
+                log_file.write(json.dumps(result) + '\n')
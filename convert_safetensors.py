@@ -0,0 +1,36 @@
+import os
+import time
+import torch
+from scripts.model_loading import load_weights, convert_to_safetensors
+from scripts.inference_context import inference_context
+
+PATH_model_seg = 'RailNet_DT/assets/models_pretrained/segformer/SegFormer_B3_1024_finetuned.pth'
+PATH_model_deeplab = 'RailNet_DT/assets/models_pretrained/deeplabv3/DeepLabv3_finetuned.pth'
+
+def logits(model, inputs, model_type):
+    with inference_context():
+        outputs = model(inputs)
+    return outputs.logits if model_type == 'segformer' else outputs['out']
+
+if __name__ == "__main__":
+    # one-time conversion of the pickled models, load_model (scripts/test_filtered_cls.py) takes the .safetensors paths afterwards
+    models = {"segformer": PATH_model_seg, "deeplab": PATH_model_deeplab}
+    image_size = [1024,1024]
+
+    inputs = torch.randn(1, 3, image_size[0], image_size[1])
+    for model_type, PATH_model in models.items():
+        if not os.path.exists(PATH_model):
+            print('{} not found, skipped'.format(PATH_model))
+            continue
+        PATH_safetensors = convert_to_safetensors(PATH_model)
+
+        start = time.perf_counter()
+        model_ref = load_weights(PATH_model)
+        time_ref = time.perf_counter() - start
+        start = time.perf_counter()
+        model = load_weights(PATH_safetensors)
+        time_safetensors = time.perf_counter() - start
+
+        if not torch.equal(logits(model_ref, inputs, model_type), logits(model, inputs, model_type)):
+            raise SystemExit('The outputs of {} differ from those of {}.'.format(PATH_safetensors, PATH_model))
+        print('Converted {} to {} | load: {:.2f} s -> {:.2f} s | outputs identical'.format(PATH_model, PATH_safetensors, time_ref, time_safetensors))
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from scripts.test_filtered_cls import load, load_model, process
+from scripts.backends import export_onnx
+
+PATH_jpgs = 'RailNet_DT/assets/rs19val/jpgs/test'
+PATH_model_seg = 'RailNet_DT/assets/models_pretrained/segformer/SegFormer_B3_1024_finetuned.pth'
+PATH_model_deeplab = 'RailNet_DT/assets/models_pretrained/deeplabv3/DeepLabv3_finetuned.pth'
+
+def validate_backend(model_ref, model_test, model_type, PATH_jpgs, image_size):
+    """
+    Compares the id maps of two backends on the sample images.
+
+    Returns:
+    A dict with filenames as keys and the number of differing pixels as values.
+    """
+    mismatches = {}
+    for filename in sorted(os.listdir(PATH_jpgs)):
+        image_norm, _, _, mask, _ = load(filename, PATH_jpgs, image_size, dataset_type='railsem19')
+        id_map_ref = process(model_ref, image_norm, mask, model_type)
+        id_map_test = process(model_test, image_norm, mask, model_type)
+        mismatches[filename] = int(np.count_nonzero(id_map_ref != id_map_test))
+
+    return mismatches
+
+if __name__ == "__main__":
+    model_type = "segformer" #segformer or deeplab
+    image_size = [1024,1024]
+    intra_op_threads = 0 # 0 = all physical cores
+    inter_op_threads = 0
+
+    PATH_model = PATH_model_seg if model_type == "segformer" else PATH_model_deeplab
+    PATH_onnx = os.path.splitext(PATH_model)[0] + '.onnx'
+
+    model = load_model(PATH_model)
+    export_onnx(model, PATH_onnx, model_type, image_size)
+    print('Exported as: {}'.format(PATH_onnx))
+
+    model_onnx = load_model(PATH_onnx, backend='onnx', intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+    mismatches = validate_backend(model, model_onnx, model_type, PATH_jpgs, image_size)
+    for filename, mismatch in mismatches.items():
+        print('{} | differing pixels: {}'.format(filename, mismatch))
+
+    if any(mismatches.values()):
+        raise SystemExit('ONNX id maps differ from the PyTorch ones.')
+    print('ONNX id maps are identical to the PyTorch ones.')
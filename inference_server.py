@@ -0,0 +1,148 @@
+import os
+import time
+import json
+import cv2
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from scripts.batching import MicroBatcher, Overloaded
+from TheDistanceAssessor import segment_batch, detect_batch, assess_frame, format_classification, load_yolo, PATH_model_seg, PATH_model_det
+
+HOST = '127.0.0.1'
+PORT = 8050
+
+class InferenceService:
+    """
+    Keeps the segmentation and detection models resident. Frames of concurrent requests are coalesced by one micro-batching
+    scheduler in front of each model, the model-free assessment runs in the calling thread.
+    """
+    def __init__(self, model_seg, model_det, image_size, model_type, target_distances, num_ys=10, max_batch_size=4, max_wait_ms=10, max_queue_size=64):
+        self.model_det = model_det
+        self.target_distances = target_distances
+        self.num_ys = num_ys
+        self.segmenter = MicroBatcher(lambda images: segment_batch(model_seg, image_size, images, model_type),
+                                      max_batch_size, max_wait_ms, max_queue_size, name='segmentation')
+        self.detector = MicroBatcher(lambda images: detect_batch(model_det, images),
+                                     max_batch_size, max_wait_ms, max_queue_size, name='detection')
+
+    def start(self):
+        self.segmenter.start()
+        self.detector.start()
+        return self
+
+    def assess(self, image, timeout=None):
+        # raises Overloaded when a scheduler queue is full
+        id_map = self.segmenter.submit(image)
+        try:
+            result = self.detector.submit(image)
+        except Overloaded:
+            # the segmentation of a rejected frame is not run when it is still queued
+            id_map.cancel()
+            raise
+        id_map, result = id_map.result(timeout), result.result(timeout)
+        classification, _, _, _ = assess_frame(id_map, image, result, self.model_det, self.target_distances, self.num_ys)
+        return format_classification(classification, self.model_det.names, self.target_distances)
+
+    def metrics(self):
+        return {"segmentation": self.segmenter.metrics(), "detection": self.detector.metrics()}
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /assess with an encoded image (Content-Type: image/jpeg or image/png) or with JSON {"path": "<image path>"}.
+    GET /health reports that the models are loaded, GET /metrics the queue depths and batch statistics of the schedulers.
+    Requests beyond the queue capacity are rejected with 503.
+    """
+    service = None
+    timeout_s = 30
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_image(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            request = json.loads(body)
+            path = request.get("path") if isinstance(request, dict) else None
+            if not isinstance(path, str):
+                raise ValueError('The JSON body must be an object with the image path as "path".')
+            if not os.path.isfile(path):
+                raise ValueError('Image not found: {}'.format(path))
+            image = cv2.imread(path)
+        else:
+            image = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError('The image could not be decoded.')
+        return image
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {"status": "ok"})
+        elif self.path == '/metrics':
+            self._reply(200, self.service.metrics())
+        else:
+            self._reply(404, {"error": "Unknown endpoint."})
+
+    def do_POST(self):
+        if self.path != '/assess':
+            self._reply(404, {"error": "Unknown endpoint."})
+            return
+        try:
+            image = self._read_image()
+        except (ValueError, KeyError) as error:
+            self._reply(400, {"error": str(error)})
+            return
+
+        start = time.perf_counter()
+        try:
+            result = self.service.assess(image, self.timeout_s)
+        except Overloaded as error:
+            self._reply(503, {"error": str(error)})
+            return
+        except Exception as error:
+            self._reply(500, {"error": str(error)})
+            return
+        result["latency_ms"] = (time.perf_counter() - start) * 1000
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        pass # a line per frame would flood the console
+
+def create_server(service, host=HOST, port=PORT):
+    handler = type('Handler', (RequestHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+if __name__ == "__main__":
+    from scripts.test_filtered_cls import load_model
+    from scripts.inference_context import configure_inference
+
+    model_type = "segformer" #segformer or deeplab
+    backend = 'torch' #torch, int8, torchscript, compile or onnx
+    intra_op_threads, inter_op_threads = 0, 0 # onnx backend threads, 0 = all physical cores
+    num_threads, interop_threads = None, None # torch threads, None = torch defaults
+    cpu_affinity = None
+    image_size = [1024,1024]
+    target_distances = [650,1000,2000]
+    num_ys = 10
+    max_batch_size = 4
+    max_wait_ms = 10 # latency window in which frames are coalesced into one batch
+    max_queue_size = 64 # frames waiting per model, further requests get 503
+
+    configure_inference(num_threads, interop_threads, cpu_affinity)
+
+    if backend == 'onnx':
+        PATH_model_seg = os.path.splitext(PATH_model_seg)[0] + '.onnx'
+
+    model_seg = load_model(PATH_model_seg, backend, intra_op_threads, inter_op_threads, model_type, image_size)
+    model_det = load_yolo(PATH_model_det)
+
+    service = InferenceService(model_seg, model_det, image_size, model_type, target_distances, num_ys, max_batch_size, max_wait_ms, max_queue_size).start()
+    server = create_server(service)
+    print('Serving on http://{}:{} (POST /assess, GET /health, GET /metrics)'.format(HOST, PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,45 @@
+import os
+from scripts.test_filtered_cls import load_model
+from scripts.backends import export_onnx
+from scripts.inference_context import configure_inference
+from scripts.quantization import quantize_dynamic_torch, quantize_dynamic_onnx, quantize_static_onnx, create_calibration_dataset, split_calibration, evaluate, report_deltas
+
+PATH_model_seg = 'RailNet_DT/assets/models_pretrained/segformer/SegFormer_B3_1024_finetuned.pth'
+
+# (images, masks) folder pairs, their Valid subsets are split into disjoint calibration and evaluation samples
+PATH_quantization = [("RailNet_DT/rs19_val/jpgs/rs19_val", "RailNet_DT/rs19_val/uint8/rs19_val")]
+
+if __name__ == "__main__":
+    model_type = "segformer" #segformer or deeplab
+    image_size = [1024,1024]
+    num_calibration = 100
+    num_evaluation = 200
+    num_threads = 4
+    variants = ['torch_int8_dynamic', 'onnx_int8_dynamic', 'onnx_int8_static']
+
+    configure_inference(num_threads)
+    path_base = os.path.splitext(PATH_model_seg)[0]
+    model = load_model(PATH_model_seg)
+    calibration_set, evaluation_set = split_calibration(create_calibration_dataset(PATH_quantization, image_size), num_calibration, num_evaluation)
+    print('Calibration on {} samples, evaluation on the {} samples after them'.format(len(calibration_set), len(evaluation_set)))
+
+    results_fp32 = evaluate(model, evaluation_set, model_type, num_evaluation)
+    print('{:>14} | '.format('fp32') + ' | '.join('{}: {:.4f}'.format(key, value) for key, value in results_fp32.items() if key != "time_ms") + ' | time: {:.1f} ms'.format(results_fp32["time_ms"]))
+
+    if 'torch_int8_dynamic' in variants:
+        # not saved, backend = 'int8' quantizes the FP32 weights at load time
+        model_int8 = quantize_dynamic_torch(load_model(PATH_model_seg))
+        report_deltas(results_fp32, evaluate(model_int8, evaluation_set, model_type, num_evaluation), 'torch dynamic')
+
+    if 'onnx_int8_dynamic' in variants or 'onnx_int8_static' in variants:
+        path_onnx = export_onnx(model, path_base + '.onnx', model_type, image_size)
+
+    if 'onnx_int8_dynamic' in variants:
+        path_int8 = quantize_dynamic_onnx(path_onnx, path_base + '_int8_dynamic.onnx')
+        model_int8 = load_model(path_int8, backend='onnx', intra_op_threads=num_threads)
+        report_deltas(results_fp32, evaluate(model_int8, evaluation_set, model_type, num_evaluation), 'onnx dynamic')
+
+    if 'onnx_int8_static' in variants:
+        path_int8 = quantize_static_onnx(path_onnx, path_base + '_int8_static.onnx', calibration_set, num_calibration)
+        model_int8 = load_model(path_int8, backend='onnx', intra_op_threads=num_threads)
+        report_deltas(results_fp32, evaluate(model_int8, evaluation_set, model_type, num_evaluation), 'onnx static')
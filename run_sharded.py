@@ -0,0 +1,124 @@
+import os
+import time
+import json
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from TheDistanceAssessor import (segment, detect, assess_frame, format_classification, load_yolo, load_eda_table,
+                                 PATH_jpgs, PATH_base, PATH_model_seg, PATH_model_det)
+
+PATH_LOGS = 'RailNet_DT/logs'
+
+# per worker process state, set by init_worker
+worker = {}
+
+def list_frames(data_type, PATH_jpgs=PATH_jpgs):
+    """
+    Returns:
+    The frames of the dataset in processing order, as (filename, frame folder, item) tuples accepted by segment/detect.
+    """
+    if data_type == 'pilsen':
+        return [(item[1][1]["path"], PATH_base, item) for item in enumerate(load_eda_table()["data"])]
+    return [(filename, PATH_jpgs, None) for filename in sorted(os.listdir(PATH_jpgs))]
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+def init_worker(cores, config, num_threads, create_models):
+    from scripts.inference_context import configure_inference
+
+    # every worker gets its own thread budget (and cores), so that the workers do not oversubscribe the machine
+    configure_inference(num_threads, 1, cores.get())
+    worker["config"] = config
+    worker["model_seg"], worker["model_det"] = create_models(config)
+
+def load_models(config):
+    from scripts.test_filtered_cls import load_model
+
+    model_seg = load_model(config["PATH_model_seg"], config["backend"], config.get("num_threads") or 0, 1, config["model_type"], config["image_size"])
+    model_det = load_yolo(config["PATH_model_det"])
+    return model_seg, model_det
+
+def process_shard(frames):
+    config, model_seg, model_det = worker["config"], worker["model_seg"], worker["model_det"]
+    records, skipped = [], []
+    start = time.perf_counter()
+    for filename, PATH_frames, item in frames:
+        # a frame that can not be processed (unreadable image, missing mask) is skipped, the rest of the run goes on
+        try:
+            id_map, _ = segment(model_seg, config["image_size"], filename, PATH_frames, config["data_type"], config["model_type"], item=item)
+            results, model, image = detect(model_det, filename, PATH_frames)
+            classification, _, _, _ = assess_frame(id_map, image, results, model, config["target_distances"], config["num_ys"])
+        except Exception as error:
+            print('Skipped {}: {}'.format(filename, error))
+            skipped.append(filename)
+            continue
+        records.append({"frame": filename, **format_classification(classification, model.names, config["target_distances"])})
+    return os.getpid(), time.perf_counter() - start, records, skipped
+
+def run_sharded(frames, config, num_workers=None, shard_size=8, cpu_affinity=True, create_models=load_models):
+    """
+    Splits the frames into shards of shard_size frames processed by num_workers processes, each with its own model copy
+    and an equal share of the available cores as threads (pinned to these cores when cpu_affinity is set).
+    Shards are handed out on demand, so slow frames do not stall a whole worker share, and merged back in frame order.
+    Frames that can not be processed are skipped and listed in the statistics.
+
+    Returns:
+    The list of per frame records in the order of frames and the throughput statistics.
+    """
+    core_ids = available_cores()
+    num_workers = num_workers or len(core_ids)
+    threads_per_worker = max(1, len(core_ids) // num_workers)
+    config = dict(config, num_threads=threads_per_worker)
+    shards = [frames[i:i+shard_size] for i in range(0, len(frames), shard_size)]
+
+    # each worker takes its slice of the cores from the queue when it starts
+    cores = mp.get_context('spawn').Queue()
+    for i in range(num_workers):
+        cores.put(core_ids[i*threads_per_worker:(i+1)*threads_per_worker] if cpu_affinity and len(core_ids) >= num_workers else None)
+
+    records, skipped, busy = [], [], {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context('spawn'),
+                             initializer=init_worker, initargs=(cores, config, threads_per_worker, create_models)) as executor:
+        for pid, elapsed, shard_records, shard_skipped in executor.map(process_shard, shards): # map keeps the order of the shards
+            records.extend(shard_records)
+            skipped.extend(shard_skipped)
+            busy[pid] = busy.get(pid, 0) + elapsed
+    total = time.perf_counter() - start
+
+    stats = {
+        "frames": len(records),
+        "skipped": skipped,
+        "workers": num_workers,
+        "threads_per_worker": threads_per_worker,
+        "wall_time_s": total,
+        "fps": len(records) / total,
+        "worker_utilization": sum(busy.values()) / (total * num_workers),
+    }
+    return records, stats
+
+if __name__ == "__main__":
+    data_type = 'railsem19' #railsem19 or pilsen
+    model_type = "segformer" #segformer or deeplab
+    backend = 'torch' #torch, int8, torchscript, compile or onnx
+    image_size = [1024,1024]
+    target_distances = [650,1000,2000]
+    num_ys = 10
+    num_workers = 4
+    shard_size = 8
+
+    if backend == 'onnx':
+        PATH_model_seg = os.path.splitext(PATH_model_seg)[0] + '.onnx'
+
+    config = {"data_type": data_type, "model_type": model_type, "backend": backend, "image_size": image_size,
+              "target_distances": target_distances, "num_ys": num_ys, "PATH_model_seg": PATH_model_seg, "PATH_model_det": PATH_model_det}
+    frames = list_frames(data_type)
+    records, stats = run_sharded(frames, config, num_workers, shard_size)
+
+    print('frames: {} | skipped: {} | workers: {} x {} threads | wall time: {:.1f} s | {:.2f} fps | worker utilization: {:.0%}'.format(
+        stats["frames"], len(stats["skipped"]), stats["workers"], stats["threads_per_worker"], stats["wall_time_s"], stats["fps"], stats["worker_utilization"]))
+
+    os.makedirs(PATH_LOGS, exist_ok=True)
+    with open(os.path.join(PATH_LOGS, 'classification_{}_{}.jsonl'.format(data_type, time.strftime('%Y%m%d_%H%M%S'))), 'w') as log_file:
+        for record in records:
+            log_file.write(json.dumps(record) + '\n')
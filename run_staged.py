@@ -0,0 +1,152 @@
+import os
+import time
+import json
+import queue
+import cv2
+import numpy as np
+import multiprocessing as mp
+from scripts.shared_frames import SharedRing
+from run_sharded import list_frames, load_models, PATH_LOGS
+from TheDistanceAssessor import segment_batch, detect_batch, assess_frame, format_classification, PATH_model_seg, PATH_model_det
+
+FRAME_SHAPE = (1080, 1920, 3) # largest decoded frame
+ID_MAP_SHAPE = (1080, 1920) # segment output
+
+class Detections:
+    # picklable detector output with the interface used by manage_detections (results[0].boxes.xywh/.cls)
+    def __init__(self, xywh, cls):
+        self.xywh = xywh
+        self.cls = cls
+
+    @classmethod
+    def from_results(cls, results):
+        boxes = results[0].boxes
+        return [cls(np.asarray(boxes.xywh.cpu()), np.asarray(boxes.cls.cpu()))]
+
+    @property
+    def boxes(self):
+        return self
+
+def decode_stage(frames, frame_ring, out_queue):
+    # unreadable frames are passed on without a slot, the end is signalled even when the stage fails
+    try:
+        for index, (filename, PATH_frames, _) in enumerate(frames):
+            image = cv2.imread(os.path.join(PATH_frames, filename))
+            out_queue.put((index, filename, None if image is None else frame_ring.put(image)))
+    finally:
+        out_queue.put(None)
+
+def model_stage(config, create_models, frame_ring, id_map_ring, in_queue, out_queue, batch_size=1):
+    from scripts.inference_context import configure_inference
+
+    try:
+        configure_inference(config.get("num_threads"))
+        model_seg, model_det = create_models(config)
+        out_queue.put(model_det.names)
+
+        finished = False
+        while not finished:
+            batch = [in_queue.get()]
+            while len(batch) < batch_size and batch[-1] is not None and not in_queue.empty():
+                batch.append(in_queue.get())
+            if batch[-1] is None:
+                finished = True
+                batch = batch[:-1]
+            for index, filename, frame_desc in batch:
+                if frame_desc is None:
+                    out_queue.put((index, filename, None, None, None))
+            batch = [item for item in batch if item[2] is not None]
+            if not batch:
+                continue
+
+            images = [frame_ring.view(frame_desc) for _, _, frame_desc in batch]
+            id_maps = segment_batch(model_seg, config["image_size"], images, config["model_type"])
+            results = detect_batch(model_det, images)
+            del images
+            for (index, filename, frame_desc), id_map, result in zip(batch, id_maps, results):
+                id_map_desc = id_map_ring.put(id_map.astype(np.uint8))
+                out_queue.put((index, filename, frame_desc, id_map_desc, Detections.from_results(result)))
+    finally:
+        out_queue.put(None)
+
+def receive(out_queue, stages, timeout=1.0):
+    # next message of the last stage, raises instead of waiting forever when a stage died
+    while True:
+        try:
+            return out_queue.get(timeout=timeout)
+        except queue.Empty:
+            for stage in stages:
+                if not stage.is_alive() and stage.exitcode != 0:
+                    raise RuntimeError('The {} stage died with exit code {}'.format(stage.name, stage.exitcode))
+
+def run_staged(frames, config, num_slots=8, batch_size=1, create_models=load_models):
+    """
+    Runs decoding, inference (segmentation and detection) and the geometry (assess_frame) in three processes.
+    Decoded frames and id maps stay in shared memory rings, the queues carry only the slot descriptors and the boxes.
+
+    Frames that can not be read are skipped and listed in the statistics. A failing stage raises a RuntimeError.
+
+    Returns:
+    The list of per frame records in the order of frames and the throughput statistics.
+    """
+    context = mp.get_context('spawn')
+    frame_ring = SharedRing('frames', num_slots, FRAME_SHAPE, np.uint8, context)
+    id_map_ring = SharedRing('id_maps', num_slots, ID_MAP_SHAPE, np.uint8, context)
+    decoded, inferred = context.Queue(), context.Queue()
+
+    start = time.perf_counter()
+    stages = [context.Process(target=decode_stage, name='decode', args=(frames, frame_ring, decoded), daemon=True),
+              context.Process(target=model_stage, name='model', args=(config, create_models, frame_ring, id_map_ring, decoded, inferred, batch_size), daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    records, skipped = {}, []
+    try:
+        names = receive(inferred, stages)
+        while names is not None and (message := receive(inferred, stages)) is not None:
+            index, filename, frame_desc, id_map_desc, results = message
+            if frame_desc is None:
+                skipped.append(filename)
+                continue
+            classification, _, _, _ = assess_frame(id_map_ring.view(id_map_desc), frame_ring.view(frame_desc), results, None, config["target_distances"], config["num_ys"])
+            records[index] = {"frame": filename, **format_classification(classification, names, config["target_distances"])}
+            frame_ring.release(frame_desc)
+            id_map_ring.release(id_map_desc)
+        # the last stage first, a failed stage leaves the one feeding it blocked on a full ring
+        for stage in reversed(stages):
+            stage.join()
+            if stage.exitcode != 0:
+                raise RuntimeError('The {} stage failed with exit code {}'.format(stage.name, stage.exitcode))
+    finally:
+        for stage in stages:
+            if stage.is_alive():
+                stage.terminate()
+        frame_ring.close()
+        id_map_ring.close()
+    total = time.perf_counter() - start
+
+    stats = {"frames": len(records), "skipped": skipped, "wall_time_s": total, "fps": len(records) / total}
+    return [records[index] for index in sorted(records)], stats
+
+if __name__ == "__main__":
+    data_type = 'railsem19' #railsem19 or pilsen
+    model_type = "segformer" #segformer or deeplab
+    backend = 'torch' #torch, int8, torchscript, compile or onnx
+    image_size = [1024,1024]
+    target_distances = [650,1000,2000]
+    num_ys = 10
+    num_slots = 8 # frames in flight between the stages
+    batch_size = 4
+
+    if backend == 'onnx':
+        PATH_model_seg = os.path.splitext(PATH_model_seg)[0] + '.onnx'
+
+    config = {"data_type": data_type, "model_type": model_type, "backend": backend, "image_size": image_size, "num_threads": None,
+              "target_distances": target_distances, "num_ys": num_ys, "PATH_model_seg": PATH_model_seg, "PATH_model_det": PATH_model_det}
+    records, stats = run_staged(list_frames(data_type), config, num_slots, batch_size)
+    print('frames: {} | skipped: {} | wall time: {:.1f} s | {:.2f} fps'.format(stats["frames"], len(stats["skipped"]), stats["wall_time_s"], stats["fps"]))
+
+    os.makedirs(PATH_LOGS, exist_ok=True)
+    with open(os.path.join(PATH_LOGS, 'classification_{}_{}.jsonl'.format(data_type, time.strftime('%Y%m%d_%H%M%S'))), 'w') as log_file:
+        for record in records:
+            log_file.write(json.dumps(record) + '\n')
@@ -0,0 +1,49 @@
+import contextlib
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+@contextlib.contextmanager
+def restored_batch_norm_stats(module):
+    # the recomputation runs the BatchNorm layers in train mode a second time, their running statistics are put back after it
+    buffers = [buffer for layer in module.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm) for buffer in layer.buffers()]
+    saved = [buffer.clone() for buffer in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buffer, value in zip(buffers, saved):
+                buffer.copy_(value)
+
+class CheckpointedSequential(nn.Sequential):
+    """
+    nn.Sequential that keeps only its input in training and recomputes the inner activations in the backward pass.
+    Built from the blocks of an existing stage, so the parameters and their names (state_dict keys) stay the same.
+    The BatchNorm running statistics are updated once per step, as without checkpointing.
+    """
+    def _contexts(self):
+        return contextlib.nullcontext(), restored_batch_norm_stats(self)
+
+    def forward(self, input):
+        if self.training and torch.is_grad_enabled():
+            return checkpoint(super().forward, input, use_reentrant=False, context_fn=self._contexts)
+        return super().forward(input)
+
+def enable_activation_checkpointing(model):
+    """
+    Activation checkpointing of the encoder, trading a second forward pass of the encoder for the memory of its activations.
+    SegFormer (transformers) uses the built-in checkpointing of the encoder blocks, DeepLabv3 (torchvision) checkpoints
+    the ResNet stages of the backbone.
+
+    Returns:
+    The model.
+    """
+    if getattr(model, 'supports_gradient_checkpointing', False):
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    elif hasattr(model, 'backbone'):
+        for name, stage in list(model.backbone.named_children()):
+            if name.startswith('layer') and type(stage) is nn.Sequential:
+                setattr(model.backbone, name, CheckpointedSequential(*stage))
+    else:
+        raise ValueError('Activation checkpointing is not supported for {}'.format(type(model).__name__))
+    return model
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+from scripts.model_loading import load_weights
+
+class SegmentationOutput(dict):
+    """
+    Model output usable both as the SegFormer output (outputs.logits) and the DeepLab output (outputs['out']),
+    so that the alternative backends work with process() unchanged.
+    """
+    def __init__(self, logits):
+        super().__init__(out=logits, logits=logits)
+        self.logits = logits
+
+class LogitsOnly(nn.Module):
+    # exported/traced graphs return a plain logits tensor instead of the model specific output
+    def __init__(self, model, model_type):
+        super().__init__()
+        self.model = model
+        self.model_type = model_type
+
+    def forward(self, pixel_values):
+        if self.model_type == "segformer":
+            return self.model(pixel_values).logits
+        elif self.model_type == "deeplab":
+            return self.model(pixel_values)['out']
+
+def export_onnx(model, path_onnx, model_type, image_size=[1024,1024], opset=17):
+    wrapper = LogitsOnly(model.cpu(), model_type).eval()
+    dummy_input = torch.randn(1, 3, image_size[0], image_size[1])
+
+    export_args = dict(input_names=['pixel_values'],
+                       output_names=['logits'],
+                       dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+                       opset_version=opset,
+                       do_constant_folding=True)
+
+    with torch.no_grad():
+        try:
+            # the TorchScript based exporter keeps the batch axis of the SegFormer reshapes symbolic
+            torch.onnx.export(wrapper, dummy_input, path_onnx, dynamo=False, **export_args)
+        except TypeError: # older torch versions have only the TorchScript based exporter
+            torch.onnx.export(wrapper, dummy_input, path_onnx, **export_args)
+    return path_onnx
+
+class OnnxModel:
+    """
+    ONNX Runtime CPU session with the interface of the PyTorch segmentation models.
+    Thread counts of 0 leave the choice to ONNX Runtime (all physical cores).
+    """
+    def __init__(self, path_onnx, intra_op_threads=0, inter_op_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+        self.session = ort.InferenceSession(path_onnx, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, pixel_values):
+        pixel_values = np.ascontiguousarray(pixel_values.cpu().numpy(), dtype=np.float32)
+        logits = self.session.run(None, {self.input_name: pixel_values})[0]
+        return SegmentationOutput(torch.from_numpy(logits))
+
+    def cpu(self):
+        return self
+
+    def eval(self):
+        return self
+
+def file_hash(path, chunk_size=1<<24):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as model_file:
+        for chunk in iter(lambda: model_file.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def warmup_model(model, image_size, batch_size=1, iterations=3):
+    # the first calls of a TorchScript/compiled module profile and optimize the graph
+    dummy_input = torch.randn(batch_size, 3, image_size[0], image_size[1])
+    with torch.no_grad():
+        for _ in range(iterations):
+            model(dummy_input)
+
+class TracedModel:
+    """
+    TorchScript module or AOTInductor package with the interface of the PyTorch segmentation models.
+    """
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, pixel_values):
+        with torch.no_grad():
+            return SegmentationOutput(self.module(pixel_values))
+
+    def cpu(self):
+        return self
+
+    def eval(self):
+        return self
+
+def load_traced_model(path_model, model_type, image_size, method='torchscript', cache_dir=None, batch_size=1, warmup=3):
+    """
+    Builds the inference module once and reuses it by the next process starts. The module is serialized to cache_dir with
+    the weights hash and the input size in the name: TorchScript modules are frozen, 'compile' exports the model
+    (torch.export, dynamic batch size) and compiles it ahead of time with AOTInductor into a .pt2 package, so a restart
+    loads the compiled kernels without recompiling.
+
+    Returns:
+    A warmed up TracedModel.
+    """
+    cache_dir = cache_dir if cache_dir is not None else os.path.join(os.path.dirname(path_model), 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    name = os.path.splitext(os.path.basename(path_model))[0]
+    path_base = os.path.join(cache_dir, '{}_{}_{}x{}'.format(name, file_hash(path_model)[:16], image_size[0], image_size[1]))
+
+    if method == 'torchscript':
+        path_traced = path_base + '.pt'
+        if os.path.exists(path_traced):
+            module = torch.jit.load(path_traced, map_location='cpu')
+        else:
+            model = load_weights(path_model)
+            with torch.no_grad():
+                module = torch.jit.trace(LogitsOnly(model, model_type).eval(), torch.randn(batch_size, 3, image_size[0], image_size[1]))
+                module = torch.jit.freeze(module)
+            # written under a temporary name, so that concurrently starting workers never load a partial file
+            torch.jit.save(module, path_traced + '.tmp')
+            os.replace(path_traced + '.tmp', path_traced)
+    elif method == 'compile':
+        path_package = path_base + '.pt2'
+        if not os.path.exists(path_package):
+            model = load_weights(path_model)
+            # exported with a batch of 2, a batch of 1 would be specialized to a fixed batch size
+            example = torch.randn(2, 3, image_size[0], image_size[1])
+            with torch.no_grad():
+                exported = torch.export.export(LogitsOnly(model, model_type).eval(), (example,),
+                                               dynamic_shapes=({0: torch.export.Dim('batch', min=1, max=64)},))
+                torch._inductor.aoti_compile_and_package(exported, package_path=path_base + '.tmp.pt2')
+            os.replace(path_base + '.tmp.pt2', path_package)
+        module = torch._inductor.aoti_load_package(path_package)
+    else:
+        raise ValueError('Unknown method {}'.format(method))
+
+    model = TracedModel(module)
+    warmup_model(model, image_size, batch_size, warmup)
+    return model
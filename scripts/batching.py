@@ -0,0 +1,110 @@
+import time
+import queue
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+
+class Overloaded(Exception):
+    # raised by submit when the queue is full, the caller should retry later or drop the frame
+    pass
+
+class MicroBatcher:
+    """
+    Coalesces items submitted by concurrent callers into batches for batch_fn (a list of items -> a list of results in the same order).
+    A batch starts with the oldest queued item and is closed after max_batch_size items or max_wait_ms, whichever comes first.
+    Items beyond max_queue_size queued items are rejected (admission control), so the latency stays bounded under overload.
+    """
+    def __init__(self, batch_fn, max_batch_size=4, max_wait_ms=10, max_queue_size=64, name='batcher', stats_window=1000):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.name = name
+        self.requests = queue.Queue(maxsize=max_queue_size)
+        self.lock = threading.Lock()
+        self.counters = {"submitted": 0, "rejected": 0, "cancelled": 0, "completed": 0, "failed": 0, "batches": 0}
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.queue_waits = deque(maxlen=stats_window)
+        self.batch_times = deque(maxlen=stats_window)
+        self.worker = threading.Thread(target=self._serve, name=name, daemon=True)
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def submit(self, item):
+        # the returned future can be cancelled while the item is queued, it is then left out of its batch
+        future = Future()
+        try:
+            self.requests.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self.lock:
+                self.counters["rejected"] += 1
+            raise Overloaded('{}: {} items queued'.format(self.name, self.max_queue_size))
+
+        with self.lock:
+            self.counters["submitted"] += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.requests.qsize())
+        return future
+
+    def _collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _serve(self):
+        while True:
+            collected = self._collect_batch()
+            # running futures can no longer be cancelled, cancelled ones are dropped
+            batch = [request for request in collected if request[1].set_running_or_notify_cancel()]
+            if len(batch) < len(collected):
+                with self.lock:
+                    self.counters["cancelled"] += len(collected) - len(batch)
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                results = self.batch_fn([item for item, _, _ in batch])
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+                failed = 0
+            except Exception as error: # a failed batch fails its requests, the worker keeps running
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                failed = len(batch)
+
+            with self.lock:
+                self.counters["batches"] += 1
+                self.counters["completed"] += len(batch) - failed
+                self.counters["failed"] += failed
+                self.batch_sizes.append(len(batch))
+                self.queue_waits.extend(start - submitted for _, _, submitted in batch)
+                self.batch_times.append(time.perf_counter() - start)
+
+    def metrics(self):
+        """
+        Returns:
+        A dict with the request counters, the current and maximal queue depth and the recent batch size, queue wait and batch time statistics.
+        """
+        with self.lock:
+            waits = np.array(self.queue_waits) * 1000
+            return {
+                **self.counters,
+                "queue_depth": self.requests.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "max_queue_size": self.max_queue_size,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                "queue_wait_p50_ms": float(np.percentile(waits, 50)) if waits.size else 0.0,
+                "queue_wait_p99_ms": float(np.percentile(waits, 99)) if waits.size else 0.0,
+                "batch_time_mean_ms": float(np.mean(self.batch_times)) * 1000 if self.batch_times else 0.0,
+            }
@@ -0,0 +1,170 @@
+import os
+import json
+import queue
+import threading
+import torch
+from scripts.model_loading import model_config, read_safetensors
+
+def to_cpu(state):
+    # copy of a (nested) state dict with the tensors on the CPU, the training keeps modifying the originals
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+def training_state(model, optimizer=None, scheduler=None, scaler=None, epoch=None, metrics=None):
+    """
+    Returns:
+    The checkpoint content as plain tensors and python values on the CPU, loadable with torch.load(weights_only=True).
+    The config of the architecture lets load_weights (scripts/model_loading.py) rebuild the model.
+    """
+    state = {"model": to_cpu(model.state_dict()), "config": model_config(model), "epoch": epoch, "metrics": {key: float(value) for key, value in (metrics or {}).items()}}
+    for name, item in (("optimizer", optimizer), ("scheduler", scheduler), ("scaler", scaler)):
+        if item is not None:
+            state[name] = to_cpu(item.state_dict())
+    return state
+
+def write_checkpoint(path, state, use_safetensors=False):
+    """
+    Writes a checkpoint from training_state to path + '.pth', or with use_safetensors the weights to path + '.safetensors'
+    and the rest (optimizer, scheduler, scaler) to path + '.train.pth'. Files are written under a temporary name and renamed.
+
+    Returns:
+    The path of the weights file.
+    """
+    if use_safetensors:
+        from safetensors.torch import save_file
+
+        weights_path = path + '.safetensors'
+        metadata = {name: json.dumps(state.get(name)) for name in ("config", "epoch", "metrics")}
+        # safetensors stores contiguous tensors without shared memory
+        save_file({key: value.contiguous() for key, value in state["model"].items()}, weights_path + '.tmp', metadata=metadata)
+        os.replace(weights_path + '.tmp', weights_path)
+        rest = {key: value for key, value in state.items() if key not in ("model", "config")}
+        if any(name in rest for name in ("optimizer", "scheduler", "scaler")):
+            torch.save(rest, path + '.train.pth.tmp')
+            os.replace(path + '.train.pth.tmp', path + '.train.pth')
+        return weights_path
+
+    weights_path = path + '.pth'
+    torch.save(state, weights_path + '.tmp')
+    os.replace(weights_path + '.tmp', weights_path)
+    return weights_path
+
+def save_checkpoint(path, model, use_safetensors=False, **kwargs):
+    # synchronous variant of CheckpointWriter.save
+    return write_checkpoint(path, training_state(model, **kwargs), use_safetensors)
+
+def load_checkpoint(path, model=None, optimizer=None, scheduler=None, scaler=None, map_location='cpu'):
+    """
+    Loads a checkpoint written by write_checkpoint into the given objects, without unpickling any code (weights_only).
+
+    Returns:
+    The checkpoint dict (model state, epoch, metrics and the training states present).
+    """
+    if path.endswith('.safetensors'):
+        weights, metadata = read_safetensors(path)
+        state = {"model": weights, "config": json.loads(metadata.get("config", 'null')),
+                 "epoch": json.loads(metadata.get("epoch", 'null')), "metrics": json.loads(metadata.get("metrics", '{}'))}
+        train_path = path[:-len('.safetensors')] + '.train.pth'
+        if os.path.exists(train_path):
+            state.update(torch.load(train_path, map_location=map_location, weights_only=True))
+    else:
+        state = torch.load(path, map_location=map_location, weights_only=True)
+
+    if model is not None:
+        model.load_state_dict(state["model"])
+    for name, item in (("optimizer", optimizer), ("scheduler", scheduler), ("scaler", scaler)):
+        if item is not None and name in state:
+            item.load_state_dict(state[name])
+    return state
+
+class CheckpointWriter:
+    """
+    Saves checkpoints of a run on a background thread. save() only copies the states to the CPU, the serialization and the
+    disk write overlap with the training. At most max_pending copies wait for the thread, save() blocks beyond that.
+
+    The run index run_name.json in the directory records the latest and the best checkpoint by path (with the metric of the
+    best one), so the best model is not kept in memory. With resume the index of an earlier run is read and load_latest
+    continues from its latest checkpoint, otherwise the run starts a new index.
+    """
+    def __init__(self, directory, run_name, use_safetensors=False, resume=False, max_pending=1):
+        self.directory = directory
+        self.use_safetensors = use_safetensors
+        self.path_index = os.path.join(directory, '{}.json'.format(run_name))
+        self.index = {"latest": None, "best": None, "best_metric": None}
+        if resume and os.path.exists(self.path_index):
+            with open(self.path_index, 'r') as index_file:
+                self.index = json.load(index_file)
+        self.error = None
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    @property
+    def best_path(self):
+        return self.index["best"]
+
+    @property
+    def best_metric(self):
+        return self.index["best_metric"]
+
+    def _write(self):
+        while (job := self.jobs.get()) is not None:
+            name, state, best, metric = job
+            try:
+                path = write_checkpoint(os.path.join(self.directory, name), state, self.use_safetensors)
+                previous_best = self.index["best"]
+                self.index["latest"] = path
+                if best:
+                    self.index.update(best=path, best_metric=metric)
+                with open(self.path_index + '.tmp', 'w') as index_file:
+                    json.dump(self.index, index_file)
+                os.replace(self.path_index + '.tmp', self.path_index)
+                # only the current best model is kept
+                if best and previous_best not in (None, path):
+                    for old_path in (previous_best, previous_best.rsplit('.', 1)[0] + '.train.pth'):
+                        if os.path.exists(old_path):
+                            os.remove(old_path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.jobs.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint to {} failed'.format(self.directory)) from error
+
+    def save(self, name, model, optimizer=None, scheduler=None, scaler=None, epoch=None, metrics=None, best=False, metric=None):
+        """
+        Queues a checkpoint of the current states under directory/name, with best=True as the new best one (metric is recorded).
+        """
+        self._raise_error()
+        os.makedirs(self.directory, exist_ok=True)
+        state = training_state(model, optimizer, scheduler, scaler, epoch, metrics)
+        self.jobs.put((name, state, best, metric))
+
+    def load_latest(self, model, optimizer=None, scheduler=None, scaler=None, map_location='cpu'):
+        """
+        Loads the latest checkpoint of the run into the given objects.
+
+        Returns:
+        The checkpoint dict, None when the run has no checkpoint yet.
+        """
+        if self.index["latest"] is None or not os.path.exists(self.index["latest"]):
+            return None
+        return load_checkpoint(self.index["latest"], model, optimizer, scheduler, scaler, map_location)
+
+    def wait(self):
+        # blocks until the queued checkpoints are on disk
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self._raise_error()
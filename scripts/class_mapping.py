@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+
+# RailSem19 classes left out of the filtered model, the remaining ones are renumbered 0-11 and the rest is background (12)
+IGNORED_CLASSES = [0,1,2,6,8,9,15,16,19,20]
+NUM_CLASSES = 22
+VOID = 255
+
+class ClassMapping:
+    """
+    Class remapping of uint8 masks compiled into a 256-entry lookup table and applied in a single gather,
+    instead of a full-mask comparison and assignment per class. Works on numpy arrays and torch tensors,
+    the result has the dtype (and device) of the input.
+    """
+    def __init__(self, lut):
+        self.lut = np.asarray(lut, dtype=np.int64)
+        self.luts = {}
+
+    @classmethod
+    def from_remaps(cls, remaps):
+        # (old, new) pairs with the semantics of mask[mask==old] = new executed in the given order
+        lut = np.arange(256)
+        for old, new in remaps:
+            lut[lut == old] = new
+        return cls(lut)
+
+    @classmethod
+    def from_dict(cls, mapping, default=None):
+        lut = np.arange(256) if default is None else np.full(256, default)
+        for old, new in mapping.items():
+            lut[old] = new
+        return cls(lut)
+
+    def _lut(self, dtype, device=None):
+        key = (dtype, device)
+        if key not in self.luts:
+            if device is None:
+                self.luts[key] = self.lut.astype(dtype)
+            else:
+                self.luts[key] = torch.from_numpy(self.lut).to(device=device, dtype=dtype)
+        return self.luts[key]
+
+    def __call__(self, mask):
+        if isinstance(mask, torch.Tensor):
+            # an uint8 index tensor would be taken as a boolean mask
+            return self._lut(mask.dtype, mask.device)[mask.long()]
+        return self._lut(mask.dtype)[mask]
+
+def filtered_remaps(background=12):
+    remaps = [(cls, VOID) for cls in IGNORED_CLASSES]
+    cls_remaining = [num for num in range(0, NUM_CLASSES) if num not in set(IGNORED_CLASSES)]
+    remaps += [(cls, idx) for idx, cls in enumerate(cls_remaining)]
+    if background is not None:
+        remaps.append((VOID, background))
+    return remaps
+
+# ignored classes and void to background, the remaining classes renumbered
+FILTERED_CLASSES = ClassMapping.from_remaps(filtered_remaps())
+# as FILTERED_CLASSES, with the ignored classes and void kept as 255 (ignore_index of the loss)
+FILTERED_CLASSES_VOID = ClassMapping.from_remaps(filtered_remaps(background=None))
+# all classes kept, void merged into the last class (21)
+VOID_TO_LAST = ClassMapping.from_remaps([(VOID, NUM_CLASSES - 1)])
+# Pilsen evaluation: rails and tracks (0, 6, 9, 10) against everything else
+MERGED_OBJECTS = ClassMapping.from_dict({0: 1, 6: 1, 9: 1, 10: 1}, default=0)
@@ -0,0 +1,60 @@
+import time
+import torch
+from torch.utils.data import DataLoader, DistributedSampler
+from scripts.distributed import is_distributed
+
+def loader_kwargs(num_workers=0, persistent_workers=False, pin_memory=False, prefetch_factor=2):
+    # persistent_workers and prefetch_factor are valid only with worker processes, pinned memory only helps the transfers to a GPU
+    kwargs = {"num_workers": num_workers, "pin_memory": pin_memory and torch.cuda.is_available()}
+    if num_workers > 0:
+        kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    return kwargs
+
+def create_dataloader(dataset, batch_size, shuffle=True, drop_last=True, **settings):
+    """
+    DataLoader with the loading settings of the trainers (num_workers, persistent_workers, pin_memory, prefetch_factor).
+    Inside a process group (scripts/distributed.py) each process loads its own part of the dataset by a DistributedSampler,
+    set_epoch reshuffles the parts every epoch.
+    """
+    sampler = None
+    if is_distributed():
+        sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=drop_last)
+        shuffle = False
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler, drop_last=drop_last, **loader_kwargs(**settings))
+
+def set_epoch(dataloader, epoch):
+    # the DistributedSampler shuffles by the epoch number, the default sampler reshuffles on every iteration by itself
+    if isinstance(dataloader.sampler, DistributedSampler):
+        dataloader.sampler.set_epoch(epoch)
+
+def benchmark_loader(dataloader, num_batches=None, device=None):
+    """
+    Iterates the dataloader (and copies the batches to device when given) as a training loop without the model would.
+
+    Returns:
+    A dict with the time to the first batch (worker start-up), the samples and batches per second after it. An empty run
+    (no batches, e.g. a small subset with drop_last) has no first batch time (None) and zero rates.
+    """
+    num_batches = len(dataloader) if num_batches is None else min(num_batches, len(dataloader))
+    samples, batches, first_batch = 0, 0, None
+    start = time.perf_counter()
+    for i, (inputs, masks) in enumerate(dataloader if num_batches > 0 else []):
+        if device is not None:
+            inputs, masks = inputs.to(device, non_blocking=True), masks.to(device, non_blocking=True)
+        if i == 0:
+            first_batch = time.perf_counter() - start
+            start = time.perf_counter()
+        else:
+            samples += len(inputs)
+            batches += 1
+        if i + 1 >= num_batches:
+            break
+    if device is not None and device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "first_batch_s": first_batch,
+        "samples_per_s": samples / elapsed if samples else 0.0,
+        "batches_per_s": batches / elapsed if batches else 0.0,
+    }
@@ -4,10 +4,11 @@ from albumentations.pytorch import ToTensorV2
 import albumentations as A
 import numpy as np
 import cv2
-import re
+from scripts.dataset_cache import DatasetCache, load_file_index
+from scripts.class_mapping import FILTERED_CLASSES, VOID_TO_LAST
 
 class CustomDataset(VisionDataset):
-    def __init__(self, image_folder, mask_folder, image_processor, image_size, subset, val_fraction=0.1):
+    def __init__(self, image_folder, mask_folder, image_processor, image_size, subset, val_fraction=0.1, cache_dir=None):
         self.image_folder = Path(image_folder)
         self.mask_folder = Path(mask_folder)
         self.val_fraction = val_fraction
@@ -48,68 +49,59 @@ class CustomDataset(VisionDataset):
         self.transform_mask = A.Compose([
                             ToTensorV2(p=1.0),
                             ])
-        # all files
-        self.image_list = np.array(sorted(Path(self.image_folder).glob("*")))
-        self.mask_list = np.array(sorted(Path(self.mask_folder).glob("*")))
-
-        for file_path in self.image_list:
-            if 'desktop.ini' in file_path.name:
-                file_path.unlink()
-        for file_path in self.mask_list:
-            if 'desktop.ini' in file_path.name:
-                file_path.unlink()
-
-        self.mask_list = np.array(sorted(self.mask_list, key=lambda path: int(re.findall(r'\d+', path.stem)[0]) if re.findall(r'\d+', path.stem) else 0))
+        # only the Valid subset is read from the cache (pre-decoded by scripts/dataset_cache.py), the Train augmentations run on the native frames
+        if cache_dir is not None and subset == 'Valid':
+            self.cache = DatasetCache(cache_dir)
+            if self.cache.val_fraction != val_fraction:
+                raise ValueError('{} caches the Valid subset of val_fraction {}, not {}'.format(cache_dir, self.cache.val_fraction, val_fraction))
+            self.image_list, self.mask_list = self.cache.image_list, self.cache.mask_list
+        else:
+            self.cache = None
+            # all files, listed once and reused from the index in RailNet_DT/cache
+            self.image_list, self.mask_list = load_file_index(self.image_folder, self.mask_folder)
 
         if subset == 'Train':  # split dataset to 1-fraction of train data, default fraction == 0.1
             self.image_names = self.image_list[:int(np.ceil(len(self.image_list) * (1 - self.val_fraction)))]
             self.mask_names = self.mask_list[:int(np.ceil(len(self.mask_list) * (1 - self.val_fraction)))]
+            self.rows = np.arange(len(self.image_names))
         elif subset == 'Valid':  # val data - data of length fraction
             self.image_names = self.image_list[int(np.ceil(len(self.image_list) * (1 - self.val_fraction))):]
             self.mask_names = self.mask_list[int(np.ceil(len(self.mask_list) * (1 - self.val_fraction))):]
+            self.rows = np.arange(len(self.image_list) - len(self.image_names), len(self.image_list))
         else:
             print('Invalid data subset.')
 
     def __len__(self) -> int:
         return len(self.image_names)
 
-    def __getitem__(self, idx):
-        image_path = self.image_names[idx]
-        mask_path = self.mask_names[idx]
-
-        with open(image_path, "rb") as image_file, open(mask_path, "rb") as mask_file:
-
-            image_init = cv2.imread(image_file.name)
-            mask_init = cv2.imread(mask_file.name, cv2.IMREAD_GRAYSCALE)
-            
-            transformed = self.transform_base(image=image_init, mask=mask_init)
-            transformed_image = transformed['image']
-            transformed_mask = transformed['mask']
-            
-            # ignore not well segmented classes
-            ignore = False
-            if ignore:
-                ignore_list = [0,1,2,6,8,9,15,16,19,20]
-                for cls in ignore_list:
-                    transformed_mask[transformed_mask==cls] = 255
+    def _read(self, idx):
+        if self.cache is not None:
+            return self.cache.read(self.rows[idx])
 
-                ignore_set = set(ignore_list)
-                cls_remaining = [num for num in range(0, 22) if num not in ignore_set]
+        with open(self.image_names[idx], "rb") as image_file, open(self.mask_names[idx], "rb") as mask_file:
+            return cv2.imread(image_file.name), cv2.imread(mask_file.name, cv2.IMREAD_GRAYSCALE)
 
-                # renumber the remaining classes 0-number of remaining classes
-                for idx, cls in enumerate(cls_remaining):
-                    transformed_mask[transformed_mask==cls] = idx
-
-                transformed_mask[transformed_mask==255] = 12 # background
-            else:
-                transformed_mask[transformed_mask==255] = 21
-            
-            encoded_inputs = self.image_processor(transformed_image, transformed_mask, return_tensors="pt")
+    def __getitem__(self, idx):
+        image_init, mask_init = self._read(idx)
+        
+        transformed = self.transform_base(image=image_init, mask=mask_init)
+        transformed_image = transformed['image']
+        transformed_mask = transformed['mask']
         
-            for k,v in encoded_inputs.items():
-                encoded_inputs[k].squeeze_() # remove batch dimension
+        # ignore not well segmented classes
+        ignore = False
+        if ignore:
+            # renumber the remaining classes 0-number of remaining classes, the ignored ones are background (12)
+            transformed_mask = FILTERED_CLASSES(transformed_mask)
+        else:
+            transformed_mask = VOID_TO_LAST(transformed_mask)
+        
+        encoded_inputs = self.image_processor(transformed_image, transformed_mask, return_tensors="pt")
+    
+        for k,v in encoded_inputs.items():
+            encoded_inputs[k].squeeze_() # remove batch dimension
 
-            image = encoded_inputs["pixel_values"]
-            mask = encoded_inputs["labels"]
-            
-            return [image,mask]
\ No newline at end of file
+        image = encoded_inputs["pixel_values"]
+        mask = encoded_inputs["labels"]
+        
+        return [image,mask]
\ No newline at end of file
@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import hashlib
+import cv2
+import numpy as np
+from pathlib import Path
+
+PATH_CACHE = 'RailNet_DT/cache'
+
+def list_dataset_files(image_folder, mask_folder):
+    """
+    Image and mask files in the order of CustomDataset: images sorted by name, masks by the number in the file name.
+    """
+    image_list = sorted(path for path in Path(image_folder).glob("*") if 'desktop.ini' not in path.name)
+    mask_list = sorted((path for path in Path(mask_folder).glob("*") if 'desktop.ini' not in path.name),
+                       key=lambda path: int(re.findall(r'\d+', path.stem)[0]) if re.findall(r'\d+', path.stem) else 0)
+    return image_list, mask_list
+
+def load_file_index(image_folder, mask_folder, cache_dir=PATH_CACHE):
+    """
+    list_dataset_files with the result persisted in cache_dir, so that the runs and sweep agents on the same folders do not
+    glob and sort them again. The index is rebuilt when the modification time of a folder changes (files added or removed).
+
+    Returns:
+    The image and mask paths as numpy arrays.
+    """
+    key = hashlib.sha1('{}|{}'.format(os.path.abspath(image_folder), os.path.abspath(mask_folder)).encode()).hexdigest()[:16]
+    path_index = os.path.join(cache_dir, 'file_index_{}.json'.format(key))
+    stamp = [os.stat(image_folder).st_mtime_ns, os.stat(mask_folder).st_mtime_ns]
+
+    if os.path.exists(path_index):
+        with open(path_index, 'r') as index_file:
+            index = json.load(index_file)
+        if index["stamp"] == stamp:
+            return np.array([Path(path) for path in index["images"]]), np.array([Path(path) for path in index["masks"]])
+
+    image_list, mask_list = list_dataset_files(image_folder, mask_folder)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written under a temporary name, concurrently starting agents never read a partial index
+    with open(path_index + '.{}.tmp'.format(os.getpid()), 'w') as index_file:
+        json.dump({"stamp": stamp, "images": [str(path) for path in image_list], "masks": [str(path) for path in mask_list]}, index_file)
+    os.replace(path_index + '.{}.tmp'.format(os.getpid()), path_index)
+    return np.array(image_list), np.array(mask_list)
+
+def build_cache(image_folder, mask_folder, cache_dir, image_size=[1024,1024], val_fraction=0.1):
+    """
+    Decodes the images and masks of the Valid subset (the last val_fraction of the files, as in CustomDataset) once, resizes
+    them to image_size (nearest neighbour, as the Valid transform) and writes them into two memory-mappable uint8 arrays
+    (images.npy: N x H x W x 3, masks.npy: N x H x W) with an index.json. The Train subset is not cached: its augmentations
+    (crops, scaling, rotation) have to run on the frames at their native resolution.
+
+    Returns:
+    The cache_dir.
+    """
+    image_list, mask_list = list_dataset_files(image_folder, mask_folder)
+    first_row = int(np.ceil(len(image_list) * (1 - val_fraction)))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    num_rows = len(image_list) - first_row
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy.tmp'), mode='w+', dtype=np.uint8, shape=(num_rows, image_size[0], image_size[1], 3))
+    masks = np.lib.format.open_memmap(os.path.join(cache_dir, 'masks.npy.tmp'), mode='w+', dtype=np.uint8, shape=(num_rows, image_size[0], image_size[1]))
+    for idx, (image_path, mask_path) in enumerate(zip(image_list[first_row:], mask_list[first_row:])):
+        image = cv2.imread(str(image_path))
+        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+        images[idx] = cv2.resize(image, (image_size[1], image_size[0]), interpolation=cv2.INTER_NEAREST)
+        masks[idx] = cv2.resize(mask, (image_size[1], image_size[0]), interpolation=cv2.INTER_NEAREST)
+    images.flush()
+    masks.flush()
+    del images, masks
+
+    # the index is written last, a cache without it is incomplete
+    os.replace(os.path.join(cache_dir, 'images.npy.tmp'), os.path.join(cache_dir, 'images.npy'))
+    os.replace(os.path.join(cache_dir, 'masks.npy.tmp'), os.path.join(cache_dir, 'masks.npy'))
+    index = {
+        "image_folder": str(image_folder),
+        "mask_folder": str(mask_folder),
+        "image_size": list(image_size),
+        "val_fraction": val_fraction,
+        "first_row": first_row,
+        "images": [str(path) for path in image_list],
+        "masks": [str(path) for path in mask_list],
+    }
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as index_file:
+        json.dump(index, index_file)
+    return cache_dir
+
+class DatasetCache:
+    """
+    Read access to a cache written by build_cache. The arrays are memory-mapped on the first access in each process
+    (also in every DataLoader worker), so rows are read zero-copy from the page cache instead of decoded per epoch.
+    Rows are numbered as in the file lists, the cache holds the rows from first_row on.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as index_file:
+            self.index = json.load(index_file)
+        self.image_list = np.array([Path(path) for path in self.index["images"]])
+        self.mask_list = np.array([Path(path) for path in self.index["masks"]])
+        self.val_fraction = self.index["val_fraction"]
+        self.first_row = self.index["first_row"]
+        self.images, self.masks = None, None
+
+    def __getstate__(self):
+        # the memmaps are reopened by the workers, pickling them would copy the whole arrays
+        state = self.__dict__.copy()
+        state["images"], state["masks"] = None, None
+        return state
+
+    def __len__(self):
+        return len(self.image_list) - self.first_row
+
+    def read(self, idx):
+        if self.images is None:
+            # copy-on-write, the transforms may modify the arrays in place without touching the cache
+            self.images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='c')
+            self.masks = np.load(os.path.join(self.cache_dir, 'masks.npy'), mmap_mode='c')
+        return self.images[idx - self.first_row], self.masks[idx - self.first_row]
+
+if __name__ == "__main__":
+    LIGHT = True
+    if not LIGHT:
+        PATH_JPGS = "RailNet_DT/rs19_val/jpgs/rs19_val"
+        PATH_MASKS = "RailNet_DT/rs19_val/uint8/rs19_val"
+    else:
+        PATH_JPGS = "RailNet_DT/rs19_val_light/jpgs/rs19_val"
+        PATH_MASKS = "RailNet_DT/rs19_val_light/uint8/rs19_val"
+    image_size = [1024,1024]
+    val_fraction = 0.5 # as in the trainers and sweeps
+
+    cache_dir = os.path.join(PATH_CACHE, '{}_{}x{}'.format(Path(PATH_JPGS).parent.parent.name, image_size[0], image_size[1]))
+    build_cache(PATH_JPGS, PATH_MASKS, cache_dir, image_size, val_fraction)
+    print('Cache written to {} ({} Valid samples).'.format(cache_dir, len(DatasetCache(cache_dir))))
@@ -0,0 +1,75 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def is_main_process():
+    # rank 0 logs and saves, every process does so without a process group
+    return not is_distributed() or dist.get_rank() == 0
+
+def get_device():
+    """
+    Returns:
+    cuda:LOCAL_RANK (set by torchrun, 0 without it) when a GPU is available, the CPU otherwise.
+    """
+    if torch.cuda.is_available():
+        return torch.device('cuda:{}'.format(int(os.environ.get('LOCAL_RANK', 0))))
+    return torch.device('cpu')
+
+def setup_distributed(backend=None):
+    """
+    Joins the process group of a torchrun launch (torchrun --nproc_per_node=N train_SegFormer.py), does nothing when the
+    script is started directly. The backend is nccl with GPUs and gloo otherwise, so several CPU processes on one machine
+    train the same way as GPUs (torchrun --nproc_per_node=2 with no GPU, or backend 'gloo').
+
+    Returns:
+    The rank, the world size and the device of the process.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    device = get_device()
+    if world_size > 1 and not is_distributed():
+        backend = backend or ('nccl' if device.type == 'cuda' else 'gloo')
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        dist.init_process_group(backend)
+    return int(os.environ.get('RANK', 0)), world_size, device
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def wrap_model(model, device):
+    """
+    Returns:
+    The model wrapped in DistributedDataParallel inside a process group, the model itself otherwise.
+    """
+    if not is_distributed():
+        return model
+    return DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+def sync_gradients(model, sync=True):
+    # DDP all-reduces the gradients in every backward pass, with gradient accumulation only the last one of the window needs it
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+def all_reduce_sum(tensor):
+    # in place over all processes, the tensor stays as it is without a process group
+    if is_distributed():
+        dist.all_reduce(tensor)
+    return tensor
+
+def all_reduce_mean(value, device=None):
+    """
+    Returns:
+    The mean of a loss sum (tensor or number) over the processes, as a tensor.
+    """
+    value = value.detach().clone() if isinstance(value, torch.Tensor) else torch.tensor(float(value), device=device)
+    if is_distributed():
+        dist.all_reduce(value)
+        value /= dist.get_world_size()
+    return value
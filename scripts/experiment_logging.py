@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+def to_uint8(image):
+    # gray image for the PNG files and wandb: values in [0, 1] are scaled to 0-255 (as wandb does), other ranges min-max normalized
+    image = np.asarray(image, dtype=np.float32)
+    low, high = float(image.min()), float(image.max())
+    if low < 0 or high > 1:
+        image = (image - low) / (high - low) if high > low else np.zeros_like(image)
+    return np.round(image * 255).astype(np.uint8)
+
+def segmentation_images(logits, masks, num_classes, size=256):
+    """
+    The images of an epoch from the first sample of a batch: the input mask, the predicted ID map, the logits of the classes
+    and of the background. They are downsampled on the device so that the longer side is at most size and copied to the CPU
+    at once, instead of one full-resolution copy per class.
+
+    Returns:
+    {"Input, predicted mask, background": [...], "Classes": [...]} with lists of (image, caption) for ExperimentLogger.log.
+    """
+    logits = logits[0].detach().float()
+    height, width = logits.shape[-2:]
+    scale = min(1.0, size / max(height, width))
+    shape = (max(1, round(height * scale)), max(1, round(width * scale)))
+    with torch.no_grad():
+        logits = F.interpolate(logits.unsqueeze(0), size=shape, mode='bilinear', align_corners=False)[0]
+        mask = F.interpolate(masks[0].detach().float().view(1, 1, *masks.shape[-2:]), size=shape, mode='nearest')[0, 0]
+        id_map = logits.argmax(dim=0)
+    logits, mask, id_map = (tensor.cpu().numpy() for tensor in (logits, mask, id_map))
+
+    id_map = id_map / max(int(id_map.max()), 1)
+    mask = mask + 1
+    mask[mask == 256] = 0
+    mask = mask / num_classes
+
+    classes = [(logits[class_id], "Prediction of a class {}".format(class_id + 1)) for class_id in range(num_classes - 1)]
+    return {
+        "Input, predicted mask, background": [(mask, "Input mask"), (id_map, "Predicted ID map"), (logits[-1], "Background")],
+        "Classes": classes[0:-1],
+    }
+
+class ExperimentLogger:
+    """
+    Logs the metrics and images of a run on a background thread, the training step never waits for it. log() only queues
+    the record: at most max_pending records wait for the thread, further ones are dropped (counted in dropped) instead of
+    blocking, e.g. while wandb is slow or offline.
+
+    Every record is appended to directory/run_name/log.jsonl with its images as PNG files in directory/run_name/images, so a
+    run is logged without network. With use_wandb the records also go to the active wandb run; failing wandb calls are
+    counted in wandb_errors and the local files are written anyway. Metrics are logged every log_interval epochs and images
+    every image_interval epochs (0 for none).
+    """
+    def __init__(self, directory, run_name, use_wandb=False, log_interval=1, image_interval=1, image_size=256, max_pending=4):
+        self.directory = os.path.join(directory, run_name)
+        self.use_wandb = use_wandb
+        self.log_interval = log_interval
+        self.image_interval = image_interval
+        self.image_size = image_size
+        self.dropped = 0
+        self.wandb_errors = 0
+        os.makedirs(os.path.join(self.directory, 'images'), exist_ok=True)
+        self.records = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._write, name='experiment-logger', daemon=True)
+        self.thread.start()
+
+    def images_due(self, epoch):
+        return self.image_interval > 0 and (epoch + 1) % self.image_interval == 0
+
+    def due(self, epoch):
+        # whether anything is logged at this epoch, images are only built when images_due
+        return (epoch + 1) % self.log_interval == 0 or self.images_due(epoch)
+
+    def log(self, epoch, metrics, images=None):
+        """
+        Queues the metrics (python numbers or 0-d tensors) and images (from segmentation_images) of an epoch without blocking.
+
+        Returns:
+        False when the record was dropped.
+        """
+        metrics = {key: float(value) for key, value in metrics.items()}
+        try:
+            self.records.put_nowait((epoch, time.time(), metrics, images))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _write(self):
+        while (record := self.records.get()) is not None:
+            epoch, timestamp, metrics, images = record
+            try:
+                self._write_local(epoch, timestamp, metrics, images)
+                if self.use_wandb:
+                    self._write_wandb(metrics, images)
+            except Exception as error:
+                print('Logging epoch {} failed: {}'.format(epoch + 1, error))
+            finally:
+                self.records.task_done()
+
+    def _write_local(self, epoch, timestamp, metrics, images):
+        entry = {"epoch": epoch + 1, "time": timestamp, **metrics}
+        if images:
+            entry["images"] = {}
+            for key, items in images.items():
+                paths = []
+                for number, (image, caption) in enumerate(items):
+                    name = '{:04d}_{}_{}.png'.format(epoch + 1, key.split(',')[0].lower(), number)
+                    cv2.imwrite(os.path.join(self.directory, 'images', name), to_uint8(image))
+                    paths.append({"path": os.path.join('images', name), "caption": caption})
+                entry["images"][key] = paths
+        with open(os.path.join(self.directory, 'log.jsonl'), 'a') as log_file:
+            log_file.write(json.dumps(entry) + '\n')
+
+    def _write_wandb(self, metrics, images):
+        try:
+            import wandb
+
+            if wandb.run is None:
+                return
+            data = dict(metrics)
+            for key, items in (images or {}).items():
+                data[key] = [wandb.Image(to_uint8(image), caption=caption) for image, caption in items]
+            wandb.log(data)
+        except Exception:
+            self.wandb_errors += 1
+
+    def close(self, timeout=60):
+        # waits at most timeout seconds for the queued records, a hanging wandb call does not keep the process alive
+        self.records.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print('Experiment logger of {} did not finish within {} s'.format(self.directory, timeout))
+        if self.dropped or self.wandb_errors:
+            print('Experiment logger of {}: {} records dropped, {} wandb calls failed'.format(self.directory, self.dropped, self.wandb_errors))
@@ -0,0 +1,41 @@
+import os
+import contextlib
+import torch
+
+# defaults for all inference entry points, None keeps the torch defaults
+NUM_THREADS = None
+INTEROP_THREADS = None
+CPU_AFFINITY = None # e.g. range(0, 16) to keep the process on the cores of one socket
+
+_interop_fixed = False
+
+def configure_threads(num_threads=None, interop_threads=None):
+    global _interop_fixed
+    if num_threads is not None and torch.get_num_threads() != num_threads:
+        torch.set_num_threads(num_threads)
+
+    if interop_threads is not None and not _interop_fixed and torch.get_num_interop_threads() != interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError: # can be set only once, before any inter-op parallel work started
+            _interop_fixed = True
+            print('Inter-op threads already initialized to {}, keeping them.'.format(torch.get_num_interop_threads()))
+
+def pin_affinity(cpus=None):
+    if cpus is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, set(cpus))
+
+def configure_inference(num_threads=None, interop_threads=None, cpu_affinity=None):
+    # arguments override the module defaults, pinning goes first so that the thread pools are sized for the pinned cores
+    pin_affinity(CPU_AFFINITY if cpu_affinity is None else cpu_affinity)
+    configure_threads(NUM_THREADS if num_threads is None else num_threads, INTEROP_THREADS if interop_threads is None else interop_threads)
+
+@contextlib.contextmanager
+def inference_context(num_threads=None, interop_threads=None, cpu_affinity=None):
+    """
+    Context of all model calls outside of training: no autograd graph is recorded (torch.inference_mode),
+    the thread counts and the CPU affinity are applied when given.
+    """
+    configure_inference(num_threads, interop_threads, cpu_affinity)
+    with torch.inference_mode():
+        yield
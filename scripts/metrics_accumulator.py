@@ -0,0 +1,95 @@
+import numpy as np
+import torch
+from scripts.distributed import all_reduce_sum, is_distributed
+
+# per-class metric: (name of the image mean, class selection treshold of the major variant or 0, number of values per class)
+METRICS = {"AP": ("mAP", 0, 1), "MAP": ("MmAP", 150, 1), "IoU": ("IoU", 0, 4), "MIoU": ("MIoU", 144, 4)}
+
+class MetricsAccumulator:
+    """
+    The validation metrics of compute_map_cls and compute_IoU (scripts/metrics_filtered_cls.py) for whole batches,
+    computed on the device of the logits. update() builds the confusion matrices of all images in the batch by one bincount
+    and adds the per-image means and the per-class values to running sums on the device, without a host sync.
+    compute() sums the totals over the processes of a distributed run and copies them to the CPU once at the end of the epoch.
+    With num_classes given, the zero sums are allocated on device up front, so a process without validation batches still
+    takes part in the reduction; a distributed run needs it.
+    """
+    def __init__(self, num_classes=None, background=12, device=None):
+        self.num_classes = num_classes
+        self.background = background
+        self.sums = None
+        if num_classes is not None:
+            self.reset(device)
+
+    def reset(self, device=None):
+        # sums of the per-image means, per-class sums of the values and per-class counts of the images with the class selected
+        size = self.num_classes + 1
+        self.images = 0
+        self.sums = {name: (torch.zeros((), dtype=torch.float64, device=device),
+                            torch.zeros(size, values, dtype=torch.float64, device=device),
+                            torch.zeros(size, dtype=torch.float64, device=device)) for name, (_, _, values) in METRICS.items()}
+
+    def confusion_matrices(self, logits, masks):
+        """
+        Returns:
+        Batch x (C+1) x (C+1) confusion matrices (rows ground truth, columns prediction). Ground truth values outside of
+        the C classes (the ignore index) are counted in the last row, as other classes of the masks in confusion_matrix.
+        """
+        size = self.num_classes + 1
+        batch = logits.shape[0]
+        # max over the class dimension, argmax is several times slower on CPU
+        pred = logits.max(dim=1).indices.reshape(batch, -1)
+        gt = masks.reshape(batch, -1).long().clamp(max=size - 1)
+        offset = torch.arange(batch, device=logits.device).unsqueeze(1) * size * size
+        return torch.bincount((offset + gt * size + pred).flatten(), minlength=batch * size * size).reshape(batch, size, size)
+
+    def update(self, logits, masks):
+        if self.num_classes is None:
+            self.num_classes = logits.shape[1]
+        if self.sums is None:
+            self.reset(logits.device)
+
+        cm = self.confusion_matrices(logits, masks).double()
+        tp = torch.diagonal(cm, dim1=1, dim2=2)
+        gt_count, pred_count = cm.sum(dim=2), cm.sum(dim=1)
+        total = cm.sum(dim=(1, 2)).unsqueeze(1)
+        fp, fn = pred_count - tp, gt_count - tp
+        tn = total - tp - fp - fn
+
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        # closed-form AP of a hard prediction, see average_precision_binary
+        ap = recall * precision + (1 - recall) * gt_count / total
+        stats = torch.stack([tp / (tp + fp + fn), (tp + tn) / total, precision, recall], dim=-1)
+        values = {"AP": ap.unsqueeze(-1), "MAP": ap.unsqueeze(-1), "IoU": stats, "MIoU": stats}
+
+        not_background = torch.arange(cm.shape[1], device=cm.device) != self.background
+        for name, (_, treshold, _) in METRICS.items():
+            image_sum, class_sums, class_counts = self.sums[name]
+            # classes present in both masks (more than treshold pixels in each), as select_classes
+            selected = (gt_count > treshold) & (pred_count > treshold) & not_background
+            value = torch.where(selected.unsqueeze(-1), values[name], 0)
+            # an image without a selected class counts as 0
+            image_sum += (value[..., 0].sum(dim=1) / selected.sum(dim=1).clamp(min=1)).sum()
+            class_sums += value.sum(dim=0)
+            class_counts += selected.sum(dim=0)
+        self.images += logits.shape[0]
+
+    def compute(self):
+        """
+        Returns:
+        The means over the images (mAP, MmAP, IoU, MIoU) and the per-class means (classes_AP, classes_MAP as {class: AP},
+        classes_IoU, classes_MIoU as {class: [IoU, acc, precision, recall]}) of the classes selected in at least one image.
+        """
+        results = {}
+        if self.sums is None:
+            if is_distributed():
+                raise ValueError('MetricsAccumulator needs num_classes in a distributed run, the other processes would wait for this one')
+            return results
+        images = all_reduce_sum(torch.tensor(float(self.images), dtype=torch.float64, device=self.sums["AP"][0].device)).item()
+        for name, (image_name, _, values) in METRICS.items():
+            image_sum, class_sums, class_counts = (all_reduce_sum(tensor.clone()).cpu().numpy() for tensor in self.sums[name])
+            results[image_name] = image_sum / images if images else float('nan')
+            classes = {cls: class_sums[cls] / class_counts[cls] for cls in np.flatnonzero(class_counts)}
+            results['classes_' + name] = {cls: value[0] for cls, value in classes.items()} if values == 1 else classes
+        return results
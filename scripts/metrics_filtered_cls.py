@@ -1,5 +1,4 @@
 import numpy as np
-from sklearn.metrics import average_precision_score
 from skimage import morphology
 
 
@@ -29,35 +28,86 @@ def remap_mask(mask1, mask2): # not used
 
     return mask1, mask2
 
-def compute_ap_for_cls(gt_mask, pred_mask, cls_id):
-    # flatten to binary
-    gt_flat = (gt_mask.flatten() == cls_id).astype(int)
-    pred_flat = (pred_mask.flatten() == cls_id).astype(int)
+def average_precision_binary(tp, fp, fn, total):
+    """
+    AP of a hard (0/1) prediction, equal to sklearn average_precision_score on the flattened binary masks.
+    The precision-recall curve has only the thresholds 1 (precision tp/(tp+fp), recall tp/(tp+fn))
+    and 0 (precision = share of positives, recall 1), so AP = recall_1 * precision_1 + (1 - recall_1) * positives/total.
+    """
+    positives = tp + fn
+    if tp + fp == 0: # no predicted pixels, only the threshold 0
+        return positives / total
+    recall = tp / positives
+    return recall * tp / (tp + fp) + (1 - recall) * positives / total
+
+def average_precision_scores(gt_binary, scores):
+    """
+    AP from confidences (e.g. the softmax of the class), the same step-wise sum as sklearn average_precision_score.
+    """
+    order = np.argsort(scores, kind='mergesort')[::-1]
+    scores, gt_binary = scores[order], gt_binary[order]
+    thresholds = np.r_[np.flatnonzero(np.diff(scores)), gt_binary.size - 1] # last index of every distinct score
+    tps = np.cumsum(gt_binary)[thresholds]
+    precision = tps / (thresholds + 1)
+    recall = tps / tps[-1]
+    return np.sum(np.diff(np.r_[0, recall]) * precision)
+
+def compute_ap_for_cls(gt_mask, pred_mask, cls_id, cm=None, scores=None):
+    """
+    AP of a class from the counts of the confusion matrix, or from scores (C x H x W confidences) when given.
+    """
+    cm = confusion_matrix(gt_mask, pred_mask) if cm is None else cm
+    tp, fp, fn, _, total = class_counts(cm)
 
     #if there is no occurences return 0 for the class
-    if np.sum(gt_flat) == 0:
+    if cls_id >= len(tp) or tp[cls_id] + fn[cls_id] == 0:
         return 0
-    else:
-        ap = average_precision_score(gt_flat, pred_flat)
-        return ap
-
-def compute_map_cls(gt_mask, pred_mask, classes_ap, major = False, treshold=150):
-    
-    if major: # compute mAP just from the major classes in the image (more than 150 pixels in each mask)
-        classes = get_major_classes(gt_mask, pred_mask, treshold)
-    else:
-        classes = np.unique(np.concatenate((np.unique(gt_mask),np.unique(pred_mask))))
-        classes = classes[np.isin(classes, np.unique(gt_mask)) & np.isin(classes, np.unique(pred_mask))]
+    if scores is not None:
+        return average_precision_scores(np.asarray(gt_mask).ravel() == cls_id, np.asarray(scores[cls_id]).ravel())
+    return average_precision_binary(tp[cls_id], fp[cls_id], fn[cls_id], total)
+
+def confusion_matrix(gt_mask, pred_mask, num_classes=None):
+    """
+    Confusion matrix of one image (rows ground truth, columns prediction) by a single bincount over gt*K+pred.
+    All the per-class statistics below are derived from it instead of comparing the masks class by class.
+    """
+    gt = np.asarray(gt_mask).ravel().astype(np.int64)
+    pred = np.asarray(pred_mask).ravel().astype(np.int64)
+    num_classes = num_classes or int(max(gt.max(), pred.max())) + 1
+    return np.bincount(gt * num_classes + pred, minlength=num_classes**2).reshape(num_classes, num_classes)
+
+def select_classes(cm, major=False, treshold=0):
+    # classes present in both masks, with major only those with more than treshold pixels in each mask
+    gt_count, pred_count = cm.sum(axis=1), cm.sum(axis=0)
+    if major:
+        return np.flatnonzero((gt_count > treshold) & (pred_count > treshold))
+    return np.flatnonzero((gt_count > 0) & (pred_count > 0))
+
+def class_counts(cm):
+    """
+    Returns:
+    Per-class arrays tp, fp, fn, tn and the number of pixels.
+    """
+    tp = np.diag(cm)
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+    total = cm.sum()
+    return tp, fp, fn, total - tp - fp - fn, total
+
+def compute_map_cls(gt_mask, pred_mask, classes_ap, major = False, treshold=150, background=12, cm=None, scores=None):
+    cm = confusion_matrix(gt_mask, pred_mask) if cm is None else cm
+    # compute mAP just from the classes present in both masks, with major from those with more than 150 pixels in each mask
+    classes = select_classes(cm, major, treshold)
     
-    if np.all(classes==12):
+    if np.all(classes==background):
         return 0, classes_ap
     
     # compute the AP for individual classes
     ap_values = []
     dict_ap_values = {}
     for class_index in classes:
-        if class_index != 12: # exclude background class 12
-            ap = compute_ap_for_cls(gt_mask, pred_mask, class_index)
+        if class_index != background: # exclude background class
+            ap = compute_ap_for_cls(gt_mask, pred_mask, class_index, cm, scores)
             ap_values.append(ap) # save for per picture evaluation
             dict_ap_values[class_index] = ap # save for per class evaluation
 
@@ -72,40 +122,25 @@ def compute_map_cls(gt_mask, pred_mask, classes_ap, major = False, treshold=150)
 
 
 def get_major_classes(gt_mask,pred_mask,treshold):
-    classes = np.unique(np.concatenate((np.unique(gt_mask),np.unique(pred_mask))))
-    
-    occurrences1 = {num: np.count_nonzero(gt_mask == num) for num in np.unique(gt_mask)}
-    occurrences2 = {num: np.count_nonzero(pred_mask == num) for num in np.unique(pred_mask)}
-    
-    classes = classes[[i for i, key in enumerate(classes) if occurrences1.get(key, 0) > treshold and occurrences2.get(key, 0) > treshold]]
-    
-    return classes
+    return select_classes(confusion_matrix(gt_mask, pred_mask), major=True, treshold=treshold)
 
-def compute_IoU(gt_mask, pred_mask, classes_stats, major=False, treshold=144):
-    if major: # compute mAP just from the major classes in the image (more than 144 pixels in each mask)
-        classes = get_major_classes(gt_mask, pred_mask, treshold)
-    else:
-        classes = np.unique(np.concatenate((np.unique(gt_mask),np.unique(pred_mask))))
-        classes = classes[np.isin(classes, np.unique(gt_mask)) & np.isin(classes, np.unique(pred_mask))]
+def compute_IoU(gt_mask, pred_mask, classes_stats, major=False, treshold=144, background=12, cm=None):
+    cm = confusion_matrix(gt_mask, pred_mask) if cm is None else cm
+    # compute IoU just from the classes present in both masks, with major from those with more than 144 pixels in each mask
+    classes = select_classes(cm, major, treshold)
 
-    if np.all(classes==12):
+    if np.all(classes==background):
         return(0, 0, 0, 0, classes_stats)
     
+    tp_all, fp_all, fn_all, tn_all, total = class_counts(cm)
     stats_image = {}
     
     for cls in classes:
-        if cls != 12: # excluding background
-            
-            intersection = np.sum((gt_mask == cls) & (pred_mask == cls))
-            union = np.sum((gt_mask == cls) | (pred_mask == cls))
-            IoU = intersection / union
-            
-            tp = np.sum((gt_mask == cls) & (pred_mask == cls))
-            tn = np.sum((gt_mask != cls) & (pred_mask != cls))
-            fp = np.sum((gt_mask != cls) & (pred_mask == cls))
-            fn = np.sum((gt_mask == cls) & (pred_mask != cls))
+        if cls != background: # excluding background
+            tp, fp, fn, tn = tp_all[cls], fp_all[cls], fn_all[cls], tn_all[cls]
+            IoU = tp / (tp + fp + fn)
             
-            acc = (tp+tn)/(tp+tn+fp+fn)
+            acc = (tp+tn)/total
             if tp != 0:
                 precision = tp/(tp+fp)
                 recall = tp/(tp+fn)
@@ -0,0 +1,86 @@
+import time
+import torch
+
+PRECISIONS = ['fp32', 'amp', 'bf16', 'fp16']
+
+def autocast_dtype(precision, device):
+    """
+    Returns:
+    The autocast dtype of precision on device, None for fp32. amp takes bf16 where the device supports it, fp16 otherwise.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, expected one of {}'.format(precision, PRECISIONS))
+    if precision == 'fp32':
+        return None
+    if precision == 'amp':
+        bf16 = device.type == 'cpu' or (device.type == 'cuda' and torch.cuda.is_bf16_supported())
+        return torch.bfloat16 if bf16 else torch.float16
+    return torch.bfloat16 if precision == 'bf16' else torch.float16
+
+class MixedPrecision:
+    """
+    Precision and memory format of a training run. autocast() wraps the forward pass and the loss, step() runs the backward
+    pass and the optimizer step (the latter only with update) through a GradScaler, which is active only for fp16
+    (bf16 has the fp32 exponent range).
+    With channels_last the model and the inputs use the NHWC memory format, which the convolutions of cuDNN
+    and oneDNN run faster, especially with tensor cores in fp16/bf16.
+    """
+    def __init__(self, precision='fp32', device=None, channels_last=False):
+        self.device = device or torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.precision = precision
+        self.dtype = autocast_dtype(precision, self.device)
+        self.channels_last = channels_last
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=self.dtype == torch.float16)
+
+    def prepare_model(self, model):
+        # in place for the parameters, an optimizer created before keeps its references
+        if self.channels_last:
+            model.to(memory_format=torch.channels_last)
+        return model
+
+    def prepare_inputs(self, inputs):
+        if self.channels_last:
+            return inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.dtype, enabled=self.dtype is not None)
+
+    def step(self, loss, optimizer, accumulation_steps=1, update=True):
+        # with gradient accumulation the gradients of accumulation_steps batches are summed, update only on the last of them
+        self.scaler.scale(loss / accumulation_steps).backward()  # gradients
+        if update:
+            self.scaler.step(optimizer)  # update parameters, skipped when the fp16 gradients overflowed
+            self.scaler.update()
+
+def benchmark_training(model, forward, optimizer, precision, inputs, masks, num_steps=10):
+    """
+    Runs num_steps training steps of forward(model, inputs, masks) -> loss on a fixed batch after one warm-up step.
+
+    Returns:
+    A dict with the samples per second, the mean step time and the peak memory allocated on a CUDA device (None on CPU).
+    """
+    model = precision.prepare_model(model)
+    model.train()
+    inputs, masks = precision.prepare_inputs(inputs.to(precision.device)), masks.to(precision.device)
+    cuda = precision.device.type == 'cuda'
+
+    for step in range(num_steps + 1):
+        if step == 1:
+            if cuda:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with precision.autocast():
+            loss = forward(model, inputs, masks)
+        precision.step(loss, optimizer)
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "samples_per_s": num_steps * len(inputs) / elapsed,
+        "step_time_ms": elapsed / num_steps * 1000,
+        "peak_memory_mb": torch.cuda.max_memory_allocated() / 2**20 if cuda else None,
+    }
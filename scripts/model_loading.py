@@ -0,0 +1,123 @@
+import os
+import json
+import mmap
+import struct
+import torch
+
+# dtypes of the safetensors format
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+def model_config(model):
+    """
+    Returns:
+    The architecture of a SegFormer or DeepLabv3 model as a JSON-serializable dict for build_model, None for other models.
+    """
+    model_type = getattr(getattr(model, 'config', None), 'model_type', None)
+    if model_type == 'segformer':
+        return {"model_type": 'segformer', "config": model.config.to_dict()}
+    if hasattr(model, 'backbone') and hasattr(model, 'classifier') and hasattr(model.backbone, 'layer3'):
+        return {"model_type": 'deeplab', "backbone": 'resnet101' if len(model.backbone.layer3) == 23 else 'resnet50',
+                "num_classes": model.classifier[-1].out_channels, "aux_loss": getattr(model, 'aux_classifier', None) is not None}
+    return None
+
+def build_model(config, device='meta'):
+    """
+    Builds the architecture of model_config without pretrained weights. On the meta device no parameter memory is
+    allocated and nothing is initialized, the weights are assigned by load_state_dict(assign=True) afterwards.
+
+    Returns:
+    The model in eval mode.
+    """
+    with torch.device(device):
+        if config["model_type"] == 'segformer':
+            from transformers import SegformerConfig, SegformerForSemanticSegmentation
+            model = SegformerForSemanticSegmentation(SegformerConfig.from_dict(config["config"]))
+        elif config["model_type"] == 'deeplab':
+            from torchvision import models
+            from torchvision.models.segmentation.deeplabv3 import DeepLabHead
+            create = models.segmentation.deeplabv3_resnet101 if config["backbone"] == 'resnet101' else models.segmentation.deeplabv3_resnet50
+            model = create(weights=None, weights_backbone=None, aux_loss=config["aux_loss"])
+            model.classifier = DeepLabHead(2048, config["num_classes"])
+        else:
+            raise ValueError('Unknown model type {}'.format(config["model_type"]))
+    return model.eval()
+
+def read_safetensors(path):
+    """
+    Memory-maps a safetensors file. The tensors are views of the mapping: a page is read from the file when a tensor
+    first touches it, and processes loading the same file share its pages in the page cache. The mapping is private,
+    writes (e.g. by training) copy the page and never reach the file.
+
+    Returns:
+    The state dict and the metadata of the file.
+    """
+    with open(path, 'rb') as weights_file:
+        buffer = mmap.mmap(weights_file.fileno(), 0, access=mmap.ACCESS_COPY)
+    header_size = struct.unpack('<Q', buffer[:8])[0]
+    header = json.loads(buffer[8:8 + header_size])
+    metadata = header.pop("__metadata__", None) or {}
+
+    # every tensor gets its own storage on the mapping (which it keeps alive): views of one common storage would share
+    # its autograd version counter, and an in-place update of one buffer (BatchNorm running stats) would break backward
+    state = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        if end == start:
+            state[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=torch.uint8, count=end - start, offset=8 + header_size + start)
+        if start % dtype.itemsize:  # unaligned (not written by safetensors), copied
+            tensor = tensor.clone()
+        state[name] = tensor.view(dtype).reshape(info["shape"])
+    return state, metadata
+
+def load_weights(path_model, map_location='cpu'):
+    """
+    Loads a model saved by save_checkpoint/CheckpointWriter or convert_to_safetensors: the architecture is rebuilt
+    from the stored config and the weights are assigned to it without a copy. Weights of a .safetensors file stay
+    memory-mapped on the CPU. Whole pickled models (torch.save(model), the older .pth files) are still loaded,
+    memory-mapped as well.
+
+    Returns:
+    The model in eval mode.
+    """
+    if path_model.endswith('.safetensors'):
+        state, metadata = read_safetensors(path_model)
+        config = json.loads(metadata.get("config", 'null'))
+    else:
+        checkpoint = torch.load(path_model, map_location=map_location, mmap=True, weights_only=False)
+        if isinstance(checkpoint, torch.nn.Module):
+            return checkpoint.eval()
+        state, config = checkpoint["model"], checkpoint.get("config")
+
+    if config is None:
+        raise ValueError('{} has no model config, the architecture can not be rebuilt'.format(path_model))
+    model = build_model(config)
+    model.load_state_dict(state, assign=True)
+    if str(map_location) != 'cpu':
+        model.to(map_location)
+    return model
+
+def convert_to_safetensors(path_model, path_out=None):
+    """
+    Converts a whole pickled model or a checkpoint (.pth) to a .safetensors file with the model config in its metadata.
+
+    Returns:
+    The path of the safetensors file.
+    """
+    from safetensors.torch import save_file
+
+    path_out = path_out or os.path.splitext(path_model)[0] + '.safetensors'
+    model = load_weights(path_model)
+    config = model_config(model)
+    if config is None:
+        raise ValueError('{} is not a SegFormer or DeepLabv3 model'.format(path_model))
+    # safetensors stores contiguous tensors without shared memory
+    state = {name: tensor.detach().contiguous() for name, tensor in model.state_dict().items()}
+    save_file(state, path_out + '.tmp', metadata={"config": json.dumps(config)})
+    os.replace(path_out + '.tmp', path_out)
+    return path_out
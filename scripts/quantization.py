@@ -0,0 +1,131 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import ConcatDataset, Subset
+from scripts.dataloader_RailSem19 import CustomDataset
+from scripts.metrics_filtered_cls import compute_map_cls, compute_IoU, confusion_matrix
+from scripts.test_filtered_cls import process
+from scripts.inference_context import inference_context
+
+def quantize_dynamic_torch(model):
+    # SegFormer is dominated by the attention and MLP linear layers, which get INT8 weights and dynamically quantized activations
+    model = model.cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_dynamic_onnx(path_onnx, path_onnx_int8):
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(path_onnx, path_onnx_int8, weight_type=QuantType.QInt8)
+    return path_onnx_int8
+
+def create_calibration_dataset(folders, image_size, val_fraction=0.1):
+    """
+    Builds the calibration/evaluation set from the Valid subsets of the given (image folder, mask folder) pairs by the
+    RailSem19 CustomDataset, so the images are preprocessed exactly as in the inference pipeline. The set contains only
+    these folders, the caller chooses the calibration data.
+    """
+    datasets = [CustomDataset(jpgs, masks, image_size, subset='Valid', val_fraction=val_fraction) for jpgs, masks in folders]
+    return ConcatDataset(datasets)
+
+def split_calibration(dataset, num_calibration, num_evaluation=None):
+    """
+    Splits a set from create_calibration_dataset into disjoint parts: the first num_calibration samples calibrate the
+    static model and the evaluation takes (up to num_evaluation of) the samples after them, so that the deltas against
+    FP32 are not measured on calibration frames.
+
+    Returns:
+    The calibration and the evaluation Subset.
+    """
+    num_calibration = min(num_calibration, len(dataset))
+    end = len(dataset) if num_evaluation is None else min(num_calibration + num_evaluation, len(dataset))
+    return Subset(dataset, range(num_calibration)), Subset(dataset, range(num_calibration, end))
+
+class CalibrationReader:
+    # onnxruntime CalibrationDataReader interface
+    def __init__(self, dataset, input_name='pixel_values', num_samples=100):
+        self.dataset = dataset
+        self.input_name = input_name
+        self.num_samples = min(num_samples, len(dataset))
+        self.indices = iter(range(self.num_samples))
+
+    def get_next(self):
+        idx = next(self.indices, None)
+        if idx is None:
+            return None
+        image, _ = self.dataset[idx]
+        return {self.input_name: image.unsqueeze(0).numpy().astype(np.float32)}
+
+    def rewind(self):
+        self.indices = iter(range(self.num_samples))
+
+def quantize_static_onnx(path_onnx, path_onnx_int8, dataset, num_samples=100):
+    """
+    Static INT8 quantization (QDQ, per-channel weights) of the exported ONNX model, with activation ranges calibrated on dataset samples.
+    """
+    from onnxruntime.quantization import quantize_static, QuantType, QuantFormat, CalibrationMethod
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    # graph optimization and shape inference before the quantization, as recommended by onnxruntime
+    path_onnx_pre = os.path.splitext(path_onnx_int8)[0] + '_pre.onnx'
+    quant_pre_process(path_onnx, path_onnx_pre)
+
+    reader = CalibrationReader(dataset, num_samples=num_samples)
+    quantize_static(path_onnx_pre, path_onnx_int8, reader,
+                    quant_format=QuantFormat.QDQ,
+                    op_types_to_quantize=['Conv', 'MatMul', 'Gemm'], # normalizations and softmax stay in FP32
+                    per_channel=True,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax)
+    os.remove(path_onnx_pre)
+    return path_onnx_int8
+
+def evaluate(model, dataset, model_type, num_samples=None, classes_report=[0,6,9,10]):
+    """
+    Evaluates a model (any backend) with the metrics used in scripts/test_filtered_cls.py.
+
+    Returns:
+    A dict with mAP, MmAP, IoU, MIoU, the IoU of the classes in classes_report and the mean inference time per image.
+    """
+    mAPs, MmAPs, IoUs, MIoUs = list(), list(), list(), list()
+    classes_ap, classes_Map, classes_stats, classes_Mstats = {},{},{},{}
+    elapsed = 0
+    num_samples = len(dataset) if num_samples is None else min(num_samples, len(dataset))
+
+    with inference_context():
+        for idx in range(num_samples):
+            image, mask = dataset[idx]
+            gt = mask.numpy().astype(np.uint8)
+
+            start = time.perf_counter()
+            id_map = process(model, image.unsqueeze(0), mask, model_type)
+            elapsed += time.perf_counter() - start
+
+            cm = confusion_matrix(gt, id_map)
+            map,classes_ap  = compute_map_cls(gt, id_map, classes_ap, cm=cm)
+            Mmap,classes_Map = compute_map_cls(gt, id_map, classes_Map, major = True, cm=cm)
+            IoU,_,_,_,classes_stats = compute_IoU(gt, id_map, classes_stats, cm=cm)
+            MIoU,_,_,_,classes_Mstats = compute_IoU(gt, id_map, classes_Mstats, major=True, cm=cm)
+            mAPs.append(map)
+            MmAPs.append(Mmap)
+            IoUs.append(IoU)
+            MIoUs.append(MIoU)
+
+    results = {
+        "mAP": np.nanmean(mAPs),
+        "MmAP": np.nanmean(MmAPs),
+        "IoU": np.nanmean(IoUs),
+        "MIoU": np.nanmean(MIoUs),
+        "time_ms": elapsed / num_samples * 1000,
+    }
+    for cls in classes_report:
+        value = classes_stats.get(cls)
+        results["IoU_{}".format(cls)] = np.divide(value[0], value[1])[0] if value is not None else np.nan
+
+    return results
+
+def report_deltas(results_ref, results_test, name):
+    print('{:>14} | '.format(name) + ' | '.join('{}: {:.4f} ({:+.4f})'.format(key, results_test[key], results_test[key] - results_ref[key]) for key in results_ref if key != "time_ms")
+          + ' | time: {:.1f} ms ({:.2f}x)'.format(results_test["time_ms"], results_ref["time_ms"] / results_test["time_ms"]))
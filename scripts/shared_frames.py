@@ -0,0 +1,66 @@
+import numpy as np
+import multiprocessing as mp
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+# what travels through the queues instead of the array: the ring, the slot and the shape of the data in the slot
+SlotDescriptor = namedtuple('SlotDescriptor', ['ring', 'slot', 'shape'])
+
+class SharedRing:
+    """
+    Fixed number of equally sized array slots in one shared memory block, for frames or id maps exchanged between processes.
+    The producer writes into a free slot and passes the SlotDescriptor through a queue, the consumer reads a zero-copy view
+    and releases the slot when done. Free slots are tracked by a queue, so a full ring blocks the producer (backpressure).
+
+    The ring is handed to child processes as a Process argument, they attach to the same block.
+    """
+    def __init__(self, name, num_slots, max_shape, dtype=np.uint8, context=None):
+        self.name = name
+        self.num_slots = num_slots
+        self.max_shape = tuple(max_shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.max_shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_bytes * num_slots)
+        self.owner = True
+        self.free = (context or mp.get_context('spawn')).Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shm"] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # attaching registers the block with the resource tracker of the child again, only the owner unlinks it
+        self.shm = shared_memory.SharedMemory(name=state["shm"])
+        self.owner = False
+
+    def _array(self, slot, shape):
+        return np.ndarray(shape, dtype=self.dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def put(self, array, timeout=None):
+        """
+        Copies the array into a free slot, waits for one when the ring is full.
+
+        Returns:
+        The SlotDescriptor of the slot.
+        """
+        if array.nbytes > self.slot_bytes:
+            raise ValueError('{}: array of shape {} does not fit into slots of shape {}'.format(self.name, array.shape, self.max_shape))
+        slot = self.free.get(timeout=timeout)
+        self._array(slot, array.shape)[...] = array
+        return SlotDescriptor(self.name, slot, array.shape)
+
+    def view(self, descriptor):
+        # zero-copy view, valid until the slot is released
+        return self._array(descriptor.slot, descriptor.shape)
+
+    def release(self, descriptor):
+        self.free.put(descriptor.slot)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
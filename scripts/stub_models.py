@@ -0,0 +1,109 @@
+import types
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+# boxes (x, y, w, h in full HD pixels) and COCO classes returned by the stub detector
+STUB_BOXES = [[960, 700, 120, 260],   # person in the track
+              [1500, 650, 300, 180],  # car beside the track
+              [400, 600, 80, 160],    # person far from the track
+              [1100, 500, 60, 60]]    # stationary object
+STUB_CLASSES = [0, 2, 0, 24]
+
+class StubSegmenter(nn.Module):
+    """
+    Stand-in for SegFormer with the same interface (outputs.logits at 1/4 of the input resolution),
+    but with a negligible cost, so that only the pipeline overhead is measured.
+    """
+    def __init__(self, outs=13):
+        super().__init__()
+        self.pool = nn.AvgPool2d(kernel_size=4)
+        self.classifier = nn.Conv2d(3, outs, kernel_size=1)
+
+    def forward(self, pixel_values):
+        logits = self.classifier(self.pool(pixel_values))
+        return types.SimpleNamespace(logits=logits)
+
+def create_stub_segformer(outs=13):
+    model = StubSegmenter(outs)
+    model.eval()
+    return model
+
+def create_tiny_segformer(outs=13):
+    from transformers import SegformerConfig, SegformerForSemanticSegmentation
+
+    # SegFormer architecture with a fraction of the B0 width and depth, random weights
+    config = SegformerConfig(num_labels=outs,
+                             depths=[1, 1, 1, 1],
+                             hidden_sizes=[16, 32, 64, 128],
+                             num_attention_heads=[1, 1, 2, 4],
+                             decoder_hidden_size=64)
+    model = SegformerForSemanticSegmentation(config)
+    model.eval()
+    return model
+
+class StubBoxes:
+    def __init__(self, xywh, cls):
+        self.xywh = xywh
+        self.cls = cls
+
+class StubResults:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+class StubDetector:
+    """
+    Stand-in for the ultralytics YOLO model, predict returns results with results[i].boxes.xywh and .cls.
+    Box coordinates are scaled from full HD to the size of the input image.
+    """
+    def __init__(self, boxes=STUB_BOXES, classes=STUB_CLASSES):
+        self.boxes = torch.tensor(boxes, dtype=torch.float32)
+        self.classes = torch.tensor(classes, dtype=torch.float32)
+        self.names = {i: 'class_{}'.format(i) for i in range(80)}
+        self.overrides = {}
+
+    def predict(self, images):
+        if isinstance(images, np.ndarray):
+            images = [images]
+
+        results = []
+        for image in images:
+            scale = torch.tensor([image.shape[1]/1920, image.shape[0]/1080, image.shape[1]/1920, image.shape[0]/1080])
+            results.append(StubResults(StubBoxes(self.boxes*scale, self.classes.clone())))
+        return results
+
+def create_tiny_yolo():
+    from ultralytics import YOLO
+
+    # building from the yaml config gives the yolov8n architecture with random weights (no download needed)
+    model = YOLO('yolov8n.yaml')
+    model.overrides['conf'] = 0.25
+    model.overrides['iou'] = 0.45
+    model.overrides['agnostic_nms'] = False
+    model.overrides['max_det'] = 1000
+    model.overrides['verbose'] = False
+    return model
+
+class TimedModel:
+    """
+    Wraps a segmentation model or a detector and accumulates the time spent inside of it.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.elapsed = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _timed(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        output = fn(*args, **kwargs)
+        self.elapsed += time.perf_counter() - start
+        return output
+
+    def __call__(self, *args, **kwargs):
+        return self._timed(self.model, *args, **kwargs)
+
+    def predict(self, *args, **kwargs):
+        return self._timed(self.model.predict, *args, **kwargs)
@@ -0,0 +1,435 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import itertools
+import importlib
+import warnings
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sweeps (name TEXT PRIMARY KEY, config TEXT NOT NULL, count INTEGER NOT NULL, created REAL);
+CREATE TABLE IF NOT EXISTS trials (sweep TEXT NOT NULL, number INTEGER NOT NULL, name TEXT, config TEXT NOT NULL, status TEXT NOT NULL,
+                                   value REAL, epochs INTEGER DEFAULT 0, attempts INTEGER DEFAULT 0, worker INTEGER, error TEXT,
+                                   started REAL, finished REAL, PRIMARY KEY (sweep, number));
+CREATE TABLE IF NOT EXISTS reports (sweep TEXT NOT NULL, number INTEGER NOT NULL, epoch INTEGER NOT NULL, value REAL NOT NULL,
+                                    PRIMARY KEY (sweep, number, epoch));
+'''
+
+class TrialConfig(dict):
+    # the parameters of a trial, read as attributes like wandb.config (config.learning_rate) or with config.get()
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+def quantize(value, q):
+    value = round(value / q) * q
+    return int(value) if isinstance(q, int) else value
+
+def sample_parameter(spec, rng):
+    """
+    Samples one parameter of a wandb sweep configuration: value, values (with optional probabilities) or a distribution
+    (uniform, int_uniform, q_uniform, log_uniform, q_log_uniform, log_uniform_values, q_log_uniform_values, normal).
+    """
+    if 'value' in spec:
+        return spec['value']
+    if 'values' in spec:
+        return spec['values'][rng.choice(len(spec['values']), p=spec.get('probabilities'))]
+
+    default = 'int_uniform' if isinstance(spec.get('min'), int) and isinstance(spec.get('max'), int) else 'uniform'
+    distribution = spec.get('distribution', default)
+    if distribution == 'uniform':
+        return float(rng.uniform(spec['min'], spec['max']))
+    if distribution == 'int_uniform':
+        return int(rng.integers(spec['min'], spec['max'] + 1))
+    if distribution == 'q_uniform':
+        return quantize(rng.uniform(spec['min'], spec['max']), spec.get('q', 1))
+    if distribution == 'log_uniform':  # min and max are the exponents
+        return float(math.exp(rng.uniform(spec['min'], spec['max'])))
+    if distribution == 'q_log_uniform':
+        return quantize(math.exp(rng.uniform(spec['min'], spec['max'])), spec.get('q', 1))
+    if distribution == 'log_uniform_values':
+        return float(math.exp(rng.uniform(math.log(spec['min']), math.log(spec['max']))))
+    if distribution == 'q_log_uniform_values':
+        return quantize(math.exp(rng.uniform(math.log(spec['min']), math.log(spec['max']))), spec.get('q', 1))
+    if distribution == 'normal':
+        return float(rng.normal(spec.get('mu', 0), spec.get('sigma', 1)))
+    raise ValueError('Unsupported distribution {}'.format(distribution))
+
+def sample_config(parameters, rng):
+    return {name: sample_parameter(spec, rng) for name, spec in parameters.items()}
+
+def grid_configs(parameters):
+    """
+    Returns:
+    All combinations of the parameters in a fixed order, grid search takes only value and values parameters.
+    """
+    names = sorted(parameters)
+    options = []
+    for name in names:
+        spec = parameters[name]
+        if 'value' not in spec and 'values' not in spec:
+            raise ValueError('Grid search needs value or values for the parameter {}'.format(name))
+        options.append([spec['value']] if 'value' in spec else spec['values'])
+    return [dict(zip(names, combination)) for combination in itertools.product(*options)]
+
+def encode_config(parameters, config):
+    # the swept parameters as features in [0, 1] for the Gaussian process, categorical ones one-hot, log distributions in log scale
+    features = []
+    for name, spec in sorted(parameters.items()):
+        value = config[name]
+        if 'value' in spec:
+            continue
+        if 'values' in spec:
+            features.extend(float(value == option) for option in spec['values'])
+            continue
+        distribution = spec.get('distribution', 'uniform')
+        if distribution == 'normal':
+            low, high = spec.get('mu', 0) - 3 * spec.get('sigma', 1), spec.get('mu', 0) + 3 * spec.get('sigma', 1)
+        elif distribution in ['log_uniform', 'q_log_uniform']:
+            low, high, value = spec['min'], spec['max'], math.log(value)
+        elif distribution in ['log_uniform_values', 'q_log_uniform_values']:
+            low, high, value = math.log(spec['min']), math.log(spec['max']), math.log(value)
+        else:
+            low, high = spec['min'], spec['max']
+        features.append((value - low) / (high - low) if high > low else 0.0)
+    return features
+
+def suggest_config(sweep_config, number, history, seed=0, num_initial=5, num_candidates=1000):
+    """
+    Parameters of trial number of the sweep. grid takes the combinations in order, random samples them and bayes samples
+    randomly for the first num_initial trials, then picks the candidate with the highest expected improvement of the metric
+    under a Gaussian process fitted to history, the (config, value) pairs of the finished trials. Failed trials (value None)
+    enter the process with a value below the worst finished one, so that regions that fail (e.g. out of memory) are avoided.
+
+    Returns:
+    The config of the trial, None when a grid is exhausted.
+    """
+    method = sweep_config.get('method', 'random')
+    parameters = sweep_config['parameters']
+    if method == 'grid':
+        configs = grid_configs(parameters)
+        return configs[number] if number < len(configs) else None
+
+    rng = np.random.default_rng([seed, number])
+    if method != 'bayes' or len(history) < num_initial or all(value is None for _, value in history):
+        return sample_config(parameters, rng)
+
+    from scipy.stats import norm
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern
+    from sklearn.exceptions import ConvergenceWarning
+
+    sign = -1.0 if sweep_config.get('metric', {}).get('goal', 'maximize') == 'minimize' else 1.0
+    features = np.array([encode_config(parameters, config) for config, _ in history])
+    values = sign * np.array([np.nan if value is None else value for _, value in history], dtype=float)
+    finished = values[~np.isnan(values)]
+    # pessimistic value of the failed trials: the worst finished value minus the spread of the finished values
+    values[np.isnan(values)] = finished.min() - (np.ptp(finished) or 1.0)
+    with warnings.catch_warnings():  # length scales at their bounds with few trials
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        process = GaussianProcessRegressor(Matern(nu=2.5), alpha=1e-6, normalize_y=True, random_state=0).fit(features, values)
+
+    candidates = [sample_config(parameters, rng) for _ in range(num_candidates)]
+    mean, std = process.predict(np.array([encode_config(parameters, config) for config in candidates]), return_std=True)
+    improvement = mean - values.max()
+    z = improvement / np.maximum(std, 1e-9)
+    expected_improvement = improvement * norm.cdf(z) + std * norm.pdf(z)
+    return candidates[int(np.argmax(expected_improvement))]
+
+class PercentilePruner:
+    """
+    Learning curve rule: stops a trial whose best value up to an epoch is below the percentile of the best values of the
+    other trials up to the same epoch (above the 100 - percentile when the metric is minimized), i.e. a trial of the
+    worst percentile % at that point of training. Checked every interval epochs from min_epochs on and with at least
+    min_trials other trials at that epoch, so the first trials always run to the end.
+    """
+    def __init__(self, percentile=25, min_epochs=5, min_trials=3, interval=1):
+        self.percentile = percentile
+        self.min_epochs = min_epochs
+        self.min_trials = min_trials
+        self.interval = interval
+
+    def should_prune(self, curve, others, maximize=True):
+        best = max if maximize else min
+        epoch = max(curve)
+        if epoch + 1 < self.min_epochs or (epoch + 1 - self.min_epochs) % self.interval:
+            return False
+        others = [best(value for e, value in other.items() if e <= epoch) for other in others if epoch in other]
+        if len(others) < self.min_trials:
+            return False
+        value = best(value for e, value in curve.items() if e <= epoch)
+        if maximize:
+            return value < float(np.percentile(others, self.percentile))
+        return value > float(np.percentile(others, 100 - self.percentile))
+
+class MedianPruner(PercentilePruner):
+    # median stopping rule, the trials worse than the median of the others stop
+    def __init__(self, min_epochs=5, min_trials=3, interval=1):
+        super().__init__(50, min_epochs, min_trials, interval)
+
+class ASHAPruner:
+    """
+    Asynchronous successive halving: rungs lie at min_epochs * reduction_factor**k epochs. A trial reaching a rung continues
+    only with a value in the top 1/reduction_factor of the values of all trials at that rung so far. Trials do not wait
+    for each other, with fewer than reduction_factor values at a rung every trial continues.
+    """
+    def __init__(self, min_epochs=1, reduction_factor=3):
+        if min_epochs < 1 or reduction_factor < 2:
+            raise ValueError('ASHA needs min_epochs >= 1 and reduction_factor >= 2, got {} and {}'.format(min_epochs, reduction_factor))
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+
+    def should_prune(self, curve, others, maximize=True):
+        epoch = max(curve)
+        rung = self.min_epochs
+        while rung < epoch + 1:
+            rung *= self.reduction_factor
+        if rung != epoch + 1:
+            return False
+        values = sorted([curve[epoch]] + [other[epoch] for other in others if epoch in other], reverse=maximize)
+        if len(values) < self.reduction_factor:
+            return False
+        cutoff = values[len(values) // self.reduction_factor - 1]
+        return curve[epoch] < cutoff if maximize else curve[epoch] > cutoff
+
+PRUNERS = {"percentile": PercentilePruner, "median": MedianPruner, "asha": ASHAPruner}
+
+def create_pruner(name=None, **kwargs):
+    if name is None or name == 'none':
+        return None
+    if name not in PRUNERS:
+        raise ValueError('Unknown pruner {}, expected one of {}'.format(name, list(PRUNERS)))
+    return PRUNERS[name](**kwargs)
+
+class SweepStore:
+    """
+    Sweeps, trials and the reported learning curves in a local sqlite database. Every process opens its own store,
+    the trials are claimed in write transactions so that concurrent workers never run the same one.
+    """
+    def __init__(self, path, timeout=60):
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def create_sweep(self, name, sweep_config, count):
+        # a sweep of the same name continues, with the count of the latest start
+        row = self.connection.execute('SELECT config FROM sweeps WHERE name = ?', (name,)).fetchone()
+        if row is not None and json.loads(row[0]) != json.loads(json.dumps(sweep_config)):
+            raise ValueError('The sweep {} exists with a different configuration'.format(name))
+        if row is None:
+            self.connection.execute('INSERT INTO sweeps VALUES (?, ?, ?, ?)', (name, json.dumps(sweep_config), count, time.time()))
+        else:
+            self.connection.execute('UPDATE sweeps SET count = ? WHERE name = ?', (count, name))
+
+    def sweep_config(self, name):
+        config, count = self.connection.execute('SELECT config, count FROM sweeps WHERE name = ?', (name,)).fetchone()
+        return json.loads(config), count
+
+    def requeue_interrupted(self, name):
+        # trials left running by an interrupted runner start again, called before any worker of the sweep runs
+        return self.connection.execute("UPDATE trials SET status = 'pending' WHERE sweep = ? AND status = 'running'", (name,)).rowcount
+
+    def fail_worker_trials(self, name, worker, error):
+        return self.connection.execute("UPDATE trials SET status = 'failed', error = ?, finished = ? WHERE sweep = ? AND worker = ? AND status = 'running'",
+                                (error, time.time(), name, worker)).rowcount
+
+    def claim_trial(self, name, worker, seed=0):
+        """
+        Marks the next trial of the sweep as running by worker: an interrupted trial first, a new one as long as the sweep
+        has fewer than count trials.
+
+        Returns:
+        (number, config, resumed), None when the sweep has no trial left.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute("SELECT number, config FROM trials WHERE sweep = ? AND status = 'pending' ORDER BY number LIMIT 1", (name,)).fetchone()
+            if row is not None:
+                number, config = row[0], json.loads(row[1])
+            else:
+                sweep_config, count = self.sweep_config(name)
+                number = self.connection.execute('SELECT COUNT(*) FROM trials WHERE sweep = ?', (name,)).fetchone()[0]
+                config = suggest_config(sweep_config, number, self.history(name), seed) if number < count else None
+                if config is None:
+                    self.connection.execute('COMMIT')
+                    return None
+                self.connection.execute("INSERT INTO trials (sweep, number, name, config, status) VALUES (?, ?, ?, ?, 'pending')",
+                                        (name, number, '{}_{:03d}'.format(name, number), json.dumps(config)))
+            attempts = self.connection.execute("UPDATE trials SET status = 'running', worker = ?, started = ?, attempts = attempts + 1 WHERE sweep = ? AND number = ? RETURNING attempts",
+                                               (worker, time.time(), name, number)).fetchone()[0]
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return number, config, attempts > 1
+
+    def register_trial(self, name, trial_name, config, worker):
+        """
+        Records a run scheduled outside of the runner (by wandb.agent) as a running trial of the sweep name, the sweep is
+        created without a configuration when it is not in the database yet.
+
+        Returns:
+        The number of the trial.
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute("INSERT OR IGNORE INTO sweeps VALUES (?, '{}', 0, ?)", (name, time.time()))
+            number = self.connection.execute('SELECT COUNT(*) FROM trials WHERE sweep = ?', (name,)).fetchone()[0]
+            self.connection.execute("INSERT INTO trials (sweep, number, name, config, status, attempts, worker, started) VALUES (?, ?, ?, ?, 'running', 1, ?, ?)",
+                                    (name, number, trial_name, json.dumps(config), worker, time.time()))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return number
+
+    def report(self, name, number, epoch, value):
+        self.connection.execute('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?)', (name, number, epoch, value))
+        self.connection.execute('UPDATE trials SET epochs = ? WHERE sweep = ? AND number = ?', (epoch + 1, name, number))
+
+    def curves(self, name):
+        # learning curves of the trials, {number: {epoch: value}}
+        curves = {}
+        for number, epoch, value in self.connection.execute('SELECT number, epoch, value FROM reports WHERE sweep = ?', (name,)):
+            curves.setdefault(number, {})[epoch] = value
+        return curves
+
+    def finish_trial(self, name, number, status, value=None, error=None):
+        self.connection.execute('UPDATE trials SET status = ?, value = ?, error = ?, finished = ? WHERE sweep = ? AND number = ?',
+                                (status, value, error, time.time(), name, number))
+
+    def history(self, name):
+        # (config, value) of the completed trials and (config, None) of the failed ones
+        rows = self.connection.execute("SELECT config, value, status FROM trials WHERE sweep = ? AND (status = 'failed' OR (status = 'completed' AND value IS NOT NULL))", (name,))
+        return [(json.loads(config), None if status == 'failed' else value) for config, value, status in rows]
+
+    def trials(self, name):
+        columns = ['number', 'name', 'config', 'status', 'value', 'epochs', 'attempts', 'error', 'started', 'finished']
+        rows = self.connection.execute('SELECT {} FROM trials WHERE sweep = ? ORDER BY number'.format(', '.join(columns)), (name,))
+        return [dict(zip(columns, row), config=json.loads(row[2])) for row in rows]
+
+class Trial:
+    """
+    A trial of a local sweep as seen by sweep_train: its name (the run name), its config and report(), which records the
+    metric of an epoch and tells whether the pruner stops the trial. resumed is set when an interrupted trial runs again.
+    Used as a context manager, the trial is finished on exit: completed, pruned (with the best value and the learning
+    curve so far kept) or failed on an exception. An interrupted trial stays running and is resumed by the runner.
+    """
+    def __init__(self, store, sweep, number, config, resumed=False, pruner=None, maximize=True, name=None):
+        self.store = store
+        self.sweep = sweep
+        self.number = number
+        self.name = name or '{}_{:03d}'.format(sweep, number)
+        self.config = TrialConfig(config)
+        self.resumed = resumed
+        self.pruner = pruner
+        self.maximize = maximize
+        self.best = None
+        self.pruned = False
+
+    def report(self, epoch, value):
+        value = float(value)
+        self.store.report(self.sweep, self.number, epoch, value)
+        curves = self.store.curves(self.sweep)
+        curve = curves.pop(self.number)
+        # the best value over the whole curve, including the epochs before a resume
+        self.best = max(curve.values()) if self.maximize else min(curve.values())
+        self.pruned = self.pruner is not None and self.pruner.should_prune(curve, list(curves.values()), self.maximize)
+        return self.pruned
+
+    def finish(self, status=None, error=None):
+        self.store.finish_trial(self.sweep, self.number, status or ('pruned' if self.pruned else 'completed'), self.best, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        elif issubclass(exc_type, Exception):
+            self.finish('failed', ''.join(traceback.format_exception(exc_type, exc, tb)))
+        return False
+
+def agent_trial(path_db, sweep, name, config, pruner=None, pruner_args=None, maximize=True):
+    """
+    A run of wandb.agent as a trial of the local database path_db, so that its learning curve is recorded and pruned
+    against the earlier runs of its sweep like the trials of run_sweep.
+
+    Returns:
+    The running Trial.
+    """
+    os.makedirs(os.path.dirname(path_db) or '.', exist_ok=True)
+    store = SweepStore(path_db)
+    number = store.register_trial(sweep, name, dict(config), os.getpid())
+    return Trial(store, sweep, number, config, pruner=create_pruner(pruner, **(pruner_args or {})), maximize=maximize, name=name)
+
+def run_worker(path_db, sweep, module_name, pruner=None, pruner_args=None, seed=0, wandb_project=None, devices=None):
+    # runs trials of the sweep until none is left, in a process of its own
+    if devices is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = devices
+    sweep_train = importlib.import_module(module_name).sweep_train
+    store = SweepStore(path_db)
+    sweep_config, _ = store.sweep_config(sweep)
+    maximize = sweep_config.get('metric', {}).get('goal', 'maximize') == 'maximize'
+
+    while (claimed := store.claim_trial(sweep, os.getpid(), seed)) is not None:
+        number, config, resumed = claimed
+        trial = Trial(store, sweep, number, config, resumed, create_pruner(pruner, **(pruner_args or {})), maximize)
+        run = None
+        if wandb_project is not None:
+            import wandb
+            run = wandb.init(project=wandb_project, group=sweep, name=trial.name, config=config)
+        try:
+            with trial:
+                sweep_train(trial)
+        except Exception:
+            # a failing trial does not stop the sweep
+            traceback.print_exc()
+        finally:
+            if run is not None:
+                run.finish()
+
+def run_sweep(sweep_config, module_name, path_db, sweep, count=10, num_workers=1, pruner=None, pruner_args=None, seed=0,
+              wandb_project=None, devices=None):
+    """
+    Runs count trials of a wandb-style sweep configuration with module_name.sweep_train(trial) in num_workers parallel
+    processes (the GPUs in devices assigned round-robin, e.g. ['0', '1']). Trials and learning curves are kept in the
+    sqlite database path_db: started again with the same sweep name, the runner continues an interrupted sweep and runs
+    the interrupted trials again, which resume from their latest checkpoint. The trials of a crashed worker are marked
+    failed and the worker is replaced. With wandb_project each trial is also logged as a wandb run.
+
+    Returns:
+    The trials of the sweep.
+    """
+    store = SweepStore(path_db)
+    store.create_sweep(sweep, sweep_config, count)
+    requeued = store.requeue_interrupted(sweep)
+    if requeued:
+        print('Resuming {} interrupted trial(s) of {}'.format(requeued, sweep))
+
+    context = mp.get_context('spawn')
+    workers = {}
+    def start_worker(slot):
+        device = devices[slot % len(devices)] if devices else None
+        process = context.Process(target=run_worker, name='sweep-worker-{}'.format(slot),
+                                  args=(path_db, sweep, module_name, pruner, pruner_args, seed, wandb_project, device))
+        process.start()
+        workers[process.sentinel] = (slot, process)
+
+    for slot in range(num_workers):
+        start_worker(slot)
+    while workers:
+        for sentinel in wait(list(workers)):
+            slot, process = workers.pop(sentinel)
+            process.join()
+            # a worker that crashed in a trial is replaced, one that fails before any trial is not
+            if process.exitcode != 0 and store.fail_worker_trials(sweep, process.pid, 'worker exited with code {}'.format(process.exitcode)):
+                start_worker(slot)
+    return store.trials(sweep)
@@ -7,7 +7,10 @@ import torch.nn as nn
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import torch.nn.functional as F
-from metrics_all_cls import compute_map_cls, compute_IoU, image_morpho
+from metrics_all_cls import compute_map_cls, compute_IoU, confusion_matrix, image_morpho
+from inference_context import inference_context
+from model_loading import load_weights
+from class_mapping import FILTERED_CLASSES_VOID
 from rs19_val.example_vis import rs19_label2bgr
 
 PATH_jpgs = 'RailNet_DT/rs19_val/jpgs/test'
@@ -29,15 +32,7 @@ def load(filename, input_size=[224,224]):
     mask_pth = os.path.join(PATH_masks, filename).replace('.jpg', '.png')
     mask = cv2.imread(mask_pth, cv2.IMREAD_GRAYSCALE)
 
-    ignore_list = [0,1,2,6,8,9,15,16,19,20]
-    for cls in ignore_list:
-        mask[mask==cls] = 255
-
-    ignore_set = set(ignore_list)
-    cls_remaining = [num for num in range(0, 22) if num not in ignore_set]
-    
-    for idx, cls in enumerate(cls_remaining):
-        mask[mask==cls] = idx
+    mask = FILTERED_CLASSES_VOID(mask)
 
     image_tr = transform_img(image=image)['image']
     image_tr = image_tr.unsqueeze(0)
@@ -46,7 +41,7 @@ def load(filename, input_size=[224,224]):
     mask_id_map = np.array(mask.cpu().detach().numpy(), dtype=np.uint8)
     
     # LOAD THE MODEL
-    model = torch.load(PATH_model, map_location=torch.device('cpu'))
+    model = load_weights(PATH_model)
     model, image_tr = model.cpu(), image_tr.cpu()
     model.eval()
     
@@ -188,27 +183,29 @@ if __name__ == "__main__":
         # INFERENCE + SOFTMAX
         #output = model(image_norm)['out'] #resnet deeplab
         
-        outputs = model(image_norm) # segformer
-        logits = outputs.logits
-        
-        upsampled_logits = nn.functional.interpolate(
-            logits,
-            size=mask.shape[-2:],
-            mode="bilinear",
-            align_corners=False
-        )
-
-        output  = upsampled_logits.float()
-        
-        confidence_scores = F.softmax(output, dim=1).cpu().detach().numpy().squeeze()
+        with inference_context():
+            outputs = model(image_norm) # segformer
+            logits = outputs.logits
+            
+            upsampled_logits = nn.functional.interpolate(
+                logits,
+                size=mask.shape[-2:],
+                mode="bilinear",
+                align_corners=False
+            )
+
+            output  = upsampled_logits.float()
+            
+            confidence_scores = F.softmax(output, dim=1).cpu().numpy().squeeze()
         id_map = np.argmax(confidence_scores, axis=0).astype(np.uint8)
         id_map = image_morpho(id_map)
         
         # mAP
-        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap)
-        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True)
-        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats)
-        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True)
+        cm = confusion_matrix(id_map_gt, id_map)
+        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap, cm=cm)
+        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True, cm=cm)
+        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats, cm=cm)
+        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True, cm=cm)
         
         print('{} | mAP:{:.3f}/{:.3f} | IoU:{:.3f}/{:.3f} | prec:{:.3f}/{:.3f} | rec:{:.3f}/{:.3f} | acc:{:.3f}/{:.3f}'.format(filename,map,Mmap,IoU,MIoU,prec,Mprec,rec,Mrec,acc,Macc))
         mAPs.append(map)
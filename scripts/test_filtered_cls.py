@@ -1,5 +1,4 @@
 import numpy as np
-import pandas as pd
 import torch
 import cv2
 import os
@@ -7,19 +6,30 @@ import torch.nn as nn
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import torch.nn.functional as F
-from scripts.metrics_filtered_cls import compute_map_cls, compute_IoU, image_morpho
-from rs19_val.example_vis import rs19_label2bgr
+from scripts.metrics_filtered_cls import compute_map_cls, compute_IoU, confusion_matrix, image_morpho
+from scripts.inference_context import inference_context, configure_inference
+from scripts.class_mapping import FILTERED_CLASSES
+from scripts.model_loading import load_weights
 
 PATH_jpgs = 'RailNet_DT/assets/rs19val/jpgs/test'
 PATH_masks = 'RailNet_DT/assets/rs19val/uint8/test'
 PATH_model = 'RailNet_DT/assets/models_pretrained/segformer/SegFormer_B3_1024_finetuned.pth'
 
-def load(filename, PATH_jpgs, input_size=[224,224], dataset_type='rs19val', item = None):
+def preprocess(image_in, input_size=[224,224]):
     transform_img = A.Compose([
                     A.Resize(height=input_size[0], width=input_size[1], interpolation=cv2.INTER_NEAREST),
                     A.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225], max_pixel_value=255.0, p=1.0),
                     ToTensorV2(p=1.0),
                     ])
+    image_tr = transform_img(image=image_in)['image']
+    image_tr = image_tr.unsqueeze(0)
+    
+    return image_tr.cpu()
+
+def preprocess_batch(images_in, input_size=[224,224]):
+    return torch.cat([preprocess(image_in, input_size) for image_in in images_in])
+
+def load(filename, PATH_jpgs, input_size=[224,224], dataset_type='rs19val', item = None):
     transform_mask = A.Compose([
                     A.Resize(height=input_size[0], width=input_size[1], interpolation=cv2.INTER_NEAREST),
                     ToTensorV2(p=1.0),
@@ -39,38 +49,34 @@ def load(filename, PATH_jpgs, input_size=[224,224], dataset_type='rs19val', item
     if dataset_type == 'testdata':
         image_in = cv2.resize(image_in, (1920, 1080))
     
-    image_tr = transform_img(image=image_in)['image']
-    image_tr = image_tr.unsqueeze(0)
+    image_tr = preprocess(image_in, input_size)
     image_vis = transform_mask(image=image_in)['image']
     mask = transform_mask(image=mask)['image']
     mask_id_map = np.array(mask.cpu().detach().numpy(), dtype=np.uint8)
     
-    image_tr = image_tr.cpu()
-    
     return image_tr, image_vis, image_in, mask, mask_id_map
 
-def load_model(path_model):
+def load_model(path_model, backend='torch', intra_op_threads=0, inter_op_threads=0, model_type="segformer", image_size=[1024,1024]):
+    if backend == 'onnx': # exported by export_onnx.py
+        from scripts.backends import OnnxModel
+        return OnnxModel(path_model, intra_op_threads, inter_op_threads)
+    elif backend in ['torchscript', 'compile']: # cached next to the weights, warmed up for image_size
+        from scripts.backends import load_traced_model
+        return load_traced_model(path_model, model_type, image_size, method=backend)
     
-    model = torch.load(path_model, map_location=torch.device('cpu'))
+    # the architecture rebuilt from its config, .safetensors weights memory-mapped (see convert_safetensors.py)
+    model = load_weights(path_model)
     model = model.cpu()
     model.eval()
+    
+    if backend == 'int8': # dynamic INT8 quantization of the linear layers, see quantize_model.py
+        from scripts.quantization import quantize_dynamic_torch
+        model = quantize_dynamic_torch(model)
     return model
 
 def remap_ignored_clss(id_map):
-    ignore_list = [0,1,2,6,8,9,15,16,19,20]
-    for cls in ignore_list:
-        id_map[id_map==cls] = 255
-
-    ignore_set = set(ignore_list)
-    cls_remaining = [num for num in range(0, 22) if num not in ignore_set]
-
-    # renumber the remaining classes 0-number of remaining classes
-    for idx, cls in enumerate(cls_remaining):
-        id_map[id_map==cls] = idx
-
-    id_map[id_map==255] = 12 # background
-    
-    return id_map
+    # renumber the remaining classes 0-number of remaining classes, the ignored ones are background (12)
+    return FILTERED_CLASSES(id_map)
 
 def prepare_for_display(mask, image, id_map, rs19_label2bgr, image_size = [224,224]):
     # Mask + prediction preparation
@@ -192,33 +198,42 @@ def stats_mean_and_reorder(classes_ap,classes_Map,classes_stats,classes_Mstats):
 
     return classes_ap,classes_Map,classes_stats,classes_Mstats
 
-def process(model, input_img, mask, model_type):
-    if model_type == "segformer":
-        outputs = model(input_img) # segformer
-    elif model_type == "deeplab":
-        outputs = model(input_img)['out'] # deeplab resnet
-    
-    logits = outputs.logits
-    upsampled_logits = nn.functional.interpolate(
-        logits,
-        size=mask.shape[-2:],
-        mode="bilinear",
-        align_corners=False
-    )
-    
-    output  = upsampled_logits.float()
+def process_batch(model, input_imgs, output_size, model_type):
+    with inference_context():
+        if model_type == "segformer":
+            logits = model(input_imgs).logits # segformer
+        elif model_type == "deeplab":
+            logits = model(input_imgs)['out'] # deeplab resnet
         
-    confidence_scores = F.softmax(output, dim=1).cpu().detach().numpy().squeeze()
-    id_map = np.argmax(confidence_scores, axis=0).astype(np.uint8)
-    id_map = image_morpho(id_map)
+        upsampled_logits = nn.functional.interpolate(
+            logits,
+            size=output_size,
+            mode="bilinear",
+            align_corners=False
+        )
+        
+        output  = upsampled_logits.float()
+            
+        confidence_scores = F.softmax(output, dim=1).cpu().numpy()
+    id_maps = np.argmax(confidence_scores, axis=1).astype(np.uint8)
+    id_maps = [image_morpho(id_map) for id_map in id_maps]
     
-    return id_map
+    return id_maps
+
+def process(model, input_img, mask, model_type):
+    return process_batch(model, input_img, mask.shape[-2:], model_type)[0]
 
 if __name__ == "__main__":
+    import pandas as pd
+    from rs19_val.example_vis import rs19_label2bgr
+    
     mAPs,MmAPs,IoUs,MIoUs,accs,Maccs,precs,Mprecs,recs,Mrecs= list(),list(),list(),list(),list(),list(),list(),list(),list(),list()
     classes_ap,classes_Map,classes_stats,classes_Mstats = {},{},{},{}
     images_computed = 0
     
+    configure_inference(num_threads=None, interop_threads=None, cpu_affinity=None)
+    model = load_model(PATH_model)
+    
     for filename in os.listdir(PATH_jpgs):
         images_computed += 1
         
@@ -233,16 +248,16 @@ if __name__ == "__main__":
         model_type = "segformer" #"deeplab"
         dataset_type = 'rs19val'
         image_norm, image, _, mask, id_map_gt = load(filename, PATH_jpgs, image_size, dataset_type)
-        model = load_model(PATH_model)
         # INFERENCE + SOFTMAX
         id_map = process(model, image_norm, mask, model_type)
         
         # mAP
         id_map_gt = remap_ignored_clss(id_map_gt)
-        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap)
-        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True)
-        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats)
-        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True)
+        cm = confusion_matrix(id_map_gt, id_map)
+        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap, cm=cm)
+        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True, cm=cm)
+        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats, cm=cm)
+        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True, cm=cm)
         
         print('{} | mAP:{:.3f}/{:.3f} | IoU:{:.3f}/{:.3f} | prec:{:.3f}/{:.3f} | rec:{:.3f}/{:.3f} | acc:{:.3f}/{:.3f}'.format(filename,map,Mmap,IoU,MIoU,prec,Mprec,rec,Mrec,acc,Macc))
         mAPs.append(map)
@@ -8,7 +8,10 @@ import torch.nn as nn
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import torch.nn.functional as F
-from metrics_filtered_cls import compute_map_cls, compute_IoU, image_morpho
+from metrics_filtered_cls import compute_map_cls, compute_IoU, confusion_matrix, image_morpho
+from inference_context import inference_context
+from model_loading import load_weights
+from class_mapping import MERGED_OBJECTS
 from rs19_val.example_vis import rs19_label2bgr
 
 mask_path = "RailNet_DT\\railway_dataset\media\images\mask"
@@ -42,25 +45,15 @@ def load(item, input_size=[224,224]):
     mask_id_map = np.array(mask.cpu().detach().numpy(), dtype=np.uint8)
     
     # LOAD THE MODEL
-    model = torch.load(PATH_model, map_location=torch.device('cpu'))
+    model = load_weights(PATH_model)
     model, image_tr = model.cpu(), image_tr.cpu()
     model.eval()
     
     return image_tr, image_vis, mask, mask_id_map, model
 
 def merge_ids(id_map):
-    id_to_merge = [0,6,9,10]
-    ids_all = np.unique(id_map)
-
-    for id in ids_all:
-        if id in id_to_merge:
-            id_map[id_map==id] = 30 # object
-        else:
-            id_map[id_map==id] = 0 # background
-    
-    id_map[id_map==30] = 1
-    
-    return id_map
+    # 0, 6, 9, 10 as object (1), the rest as background (0)
+    return MERGED_OBJECTS(id_map)
 
 def prepare_for_display(mask, image, id_map, rs19_label2bgr, image_size = [224,224]):
     mask[mask==1] = 100
@@ -200,19 +193,20 @@ if __name__ == "__main__":
         # INFERENCE + SOFTMAX
         #output = model(image_norm)['out'] #resnet deeplab
         
-        outputs = model(image_norm) # segformer
-        logits = outputs.logits
-        
-        upsampled_logits = nn.functional.interpolate(
-            logits,
-            size=mask.shape[-2:],
-            mode="bilinear",
-            align_corners=False
-        )
-
-        output  = upsampled_logits.float()
-        
-        confidence_scores = F.softmax(output, dim=1).cpu().detach().numpy().squeeze()
+        with inference_context():
+            outputs = model(image_norm) # segformer
+            logits = outputs.logits
+            
+            upsampled_logits = nn.functional.interpolate(
+                logits,
+                size=mask.shape[-2:],
+                mode="bilinear",
+                align_corners=False
+            )
+
+            output  = upsampled_logits.float()
+            
+            confidence_scores = F.softmax(output, dim=1).cpu().numpy().squeeze()
         id_map = np.argmax(confidence_scores, axis=0).astype(np.uint8)
         id_map = image_morpho(id_map)
         
@@ -221,10 +215,11 @@ if __name__ == "__main__":
         id_map_gt[id_map_gt == 0] = 12
         
         # mAP
-        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap)
-        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True)
-        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats)
-        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True)
+        cm = confusion_matrix(id_map_gt, id_map)
+        map,classes_ap  = compute_map_cls(id_map_gt, id_map, classes_ap, cm=cm)
+        Mmap,classes_Map = compute_map_cls(id_map_gt, id_map, classes_Map, major = True, cm=cm)
+        IoU,acc,prec,rec,classes_stats = compute_IoU(id_map_gt, id_map, classes_stats, cm=cm)
+        MIoU,Macc,Mprec,Mrec,classes_Mstats = compute_IoU(id_map_gt, id_map, classes_Mstats, major=True, cm=cm)
         
         print('{} | mAP:{:.3f}/{:.3f} | IoU:{:.3f}/{:.3f} | prec:{:.3f}/{:.3f} | rec:{:.3f}/{:.3f} | acc:{:.3f}/{:.3f}'.format(filename,map,Mmap,IoU,MIoU,prec,Mprec,rec,Mrec,acc,Macc))
         mAPs.append(map)
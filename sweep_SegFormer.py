@@ -1,8 +1,15 @@
 from scripts.dataloader_SegFormer import CustomDataset
-from scripts.metrics_filtered_cls import compute_map_cls, compute_IoU
+from scripts.metrics_accumulator import MetricsAccumulator
+from scripts.data_loading import create_dataloader
+from scripts.inference_context import inference_context
+from scripts.mixed_precision import MixedPrecision
+from scripts.activation_checkpointing import enable_activation_checkpointing
+from scripts.checkpoints import CheckpointWriter, save_checkpoint
+from scripts.model_loading import load_weights
+from scripts.experiment_logging import ExperimentLogger, segmentation_images
+from scripts.sweep_runner import agent_trial
 from transformers import SegformerModel, SegformerConfig, SegformerForSemanticSegmentation, SegformerImageProcessor
 from torch.optim import SGD, Adam, Adagrad, AdamW
-from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
 import torch.nn.functional as F
 from torchsummary import summary
@@ -15,7 +22,6 @@ import os
 import wandb
 from tqdm import tqdm
 import time
-import copy
 
 def get_image_4_wandb(path, input_size = [224,224]):
     transform_img = A.Compose([
@@ -57,6 +63,18 @@ else:
 
 PATH_MODELS = "RailNet_DT/models"
 PATH_LOGS = "RailNet_DT/logs"
+PATH_CACHE = None # pre-decoded Valid subset written by scripts/dataset_cache.py, e.g. "RailNet_DT/cache/rs19_val_light_1024x1024"
+# metrics are logged every LOG_INTERVAL epochs and images (downsampled to IMAGE_SIZE) every IMAGE_INTERVAL epochs,
+# on a background thread to PATH_LOGS/runs (JSONL + PNG, no network needed) and with WANDB to wandb as well
+LOG_INTERVAL = 1
+IMAGE_INTERVAL = 5
+IMAGE_SIZE = 256
+# DataLoader settings, num_workers=0 loads in the main process
+LOADER = {"num_workers": 4, "persistent_workers": True, "pin_memory": True, "prefetch_factor": 2}
+# runs of the wandb agent are recorded in PATH_SWEEPS and stopped by PRUNER when their MIoU falls behind the earlier runs of the sweep
+PATH_SWEEPS = "RailNet_DT/logs/sweeps.db"
+PRUNER = 'percentile' # 'percentile', 'median', 'asha' or None
+PRUNER_ARGS = {"percentile": 25, "min_epochs": 5, "min_trials": 3}
 
 
 def create_model(output_channels=1):
@@ -72,7 +90,8 @@ def create_model(output_channels=1):
     return model
 
 def load_model(model_path):
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    # a checkpoint or .safetensors file of the run, rebuilt from the stored config
+    model = load_weights(model_path)
     model.train()
     
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -80,112 +99,112 @@ def load_model(model_path):
     
     return model
 
-def train(model, num_epochs, batch_size, image_size, optimizer, criterion, scheduler, config):
+def train(model, num_epochs, batch_size, image_size, optimizer, criterion, scheduler, config, run_name, trial=None):
     start = time.time()
-    best_model = copy.deepcopy(model.state_dict())
     best_loss = 1e10
     loss = 0
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    precision = MixedPrecision(config.get('precision', 'fp32'), device, config.get('channels_last', False))
+    model = precision.prepare_model(model)
+    accumulation_steps = config.get('accumulation_steps', 1)
+    if config.get('activation_checkpointing', False):
+        enable_activation_checkpointing(model)
+    # written on a background thread, the run index keeps the latest and the best checkpoint by path
+    resume = trial is not None and trial.resumed
+    writer = CheckpointWriter(PATH_MODELS, run_name, resume=resume)
+    logger = ExperimentLogger(os.path.join(PATH_LOGS, 'runs'), run_name, WANDB and wandb.run is not None,
+                              LOG_INTERVAL, IMAGE_INTERVAL, IMAGE_SIZE)
+    start_epoch = 0
+    if resume and (checkpoint := writer.load_latest(model, optimizer, scheduler, precision.scaler)) is not None:
+        start_epoch, best_loss = checkpoint["epoch"] + 1, checkpoint["metrics"]["best_loss"]
+        print('Resuming {} from {} at epoch {}'.format(run_name, writer.index["latest"], start_epoch + 1))
 
-    for epoch in range(num_epochs):
+    # datasets and loaders are built once per run, the loader workers persist across the epochs
+    image_processor = SegformerImageProcessor(reduce_labels=False)
+    dataloaders = {}
+    for phase in ['Train', 'Valid']:
+        dataset = CustomDataset(PATH_JPGS, PATH_MASKS, image_processor, image_size, subset=phase, val_fraction=0.5, cache_dir=PATH_CACHE)
+        dataloaders[phase] = create_dataloader(dataset, batch_size, shuffle=True, drop_last=True, **LOADER)
+
+    for epoch in range(start_epoch, num_epochs):
         print('-' * 20)
         print('Epoch {}/{}'.format(epoch+1, num_epochs))
         
         # Epoch
         train_loss = 0 # for the wandb logging
         val_loss = 0 # --||--
-        val_MmAP, val_mAP, val_IoU, val_MIoU = list(), list(), list(), list()
-        classes_MAP, classes_AP, classes_IoU, classes_MIoU = {},{},{},{}
+        val_metrics = MetricsAccumulator(config.outs, background=12, device=device) # accumulated on the device, synced once per epoch
         
         dl_lentrain = 0
         dl_lenval = 0
         
         for phase in ['Train', 'Valid']:
-            
-            image_processor = SegformerImageProcessor(reduce_labels=False)
-            dataset = CustomDataset(PATH_JPGS, PATH_MASKS, image_processor, image_size, subset=phase, val_fraction=0.5)
-            dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+            dataloader = dataloaders[phase]
             
             if phase == 'Train':
                 model.train()
                 dl_lentrain = len(dataloader)
                 
-                for inputs, masks in tqdm(dataloader):
-                    inputs = inputs.to(device)
-                    masks = masks.to(device)
+                for step, (inputs, masks) in enumerate(tqdm(dataloader)):
+                    inputs = precision.prepare_inputs(inputs.to(device, non_blocking=True))
+                    masks = masks.to(device, non_blocking=True)
                     
-                    # zero the parameter gradients
-                    optimizer.zero_grad()
+                    # zero the parameter gradients at the start of each accumulation window
+                    if step % accumulation_steps == 0:
+                        optimizer.zero_grad()
                     
-                    outputs = model(inputs)
-                    logits = outputs.logits
+                    with precision.autocast():
+                        outputs = model(inputs)
+                        logits = outputs.logits
                     
-                    upsampled_logits = nn.functional.interpolate(
-                        logits,
-                        size=masks.shape[-2:],
-                        mode="bilinear",
-                        align_corners=False
-                    )
+                        upsampled_logits = nn.functional.interpolate(
+                            logits,
+                            size=masks.shape[-2:],
+                            mode="bilinear",
+                            align_corners=False
+                        )
 
-                    upsampled_logits  = upsampled_logits.float()
-                    loss = criterion(upsampled_logits, masks)
+                        upsampled_logits  = upsampled_logits.float()
+                        loss = criterion(upsampled_logits, masks)
 
-                    loss.backward()  # gradients
-                    optimizer.step()  # update parameters
+                    precision.step(loss, optimizer, accumulation_steps, update=(step + 1) % accumulation_steps == 0 or step + 1 == dl_lentrain)
 
                     train_loss += loss
                     
             elif phase == 'Valid':
                 model.eval()
                 dl_lenval = len(dataloader)
-                with torch.no_grad():
+                with inference_context():
                     for inputs, masks in tqdm(dataloader):
-                        inputs = inputs.to(device)
-                        masks = masks.to(device)
+                        inputs = precision.prepare_inputs(inputs.to(device, non_blocking=True))
+                        masks = masks.to(device, non_blocking=True)
 
-                        outputs = model(inputs)
-                        logits = outputs.logits
+                        with precision.autocast():
+                            outputs = model(inputs)
+                            logits = outputs.logits
                         
-                        upsampled_logits = nn.functional.interpolate(
-                            logits,
-                            size=masks.shape[-2:],
-                            mode="bilinear",
-                            align_corners=False
-                        )
+                            upsampled_logits = nn.functional.interpolate(
+                                logits,
+                                size=masks.shape[-2:],
+                                mode="bilinear",
+                                align_corners=False
+                            )
 
-                        upsampled_logits  = upsampled_logits.float()
-                        loss = criterion(upsampled_logits, masks)
+                            upsampled_logits  = upsampled_logits.float()
+                            loss = criterion(upsampled_logits, masks)
 
                         val_loss += loss
-                        predicted_masks = upsampled_logits
-                        gt_masks = masks.cpu().detach().numpy().squeeze()
-                        for prediction, gt in zip(predicted_masks, gt_masks):
-                            prediction = F.softmax(prediction, dim=0).cpu().detach().numpy().squeeze()
-                            prediction = np.argmax(prediction, axis=0).astype(np.uint8)
-                            
-                            mAP,classes_AP = compute_map_cls(gt, prediction, classes_AP)
-                            Mmap,classes_MAP = compute_map_cls(gt, prediction, classes_MAP, major = True)
-                            IoU,_,_,_,classes_IoU = compute_IoU(gt, prediction, classes_IoU)
-                            MIoU,_,_,_,classes_MIoU = compute_IoU(gt, prediction, classes_MIoU, major=True)
-                            val_mAP.append(mAP)
-                            val_MmAP.append(Mmap)
-                            val_IoU.append(IoU)
-                            val_MIoU.append(MIoU)
+                        val_metrics.update(upsampled_logits, masks)
 
         # Compute the epoch mAP and IoU
-        val_MmAP, val_mAP = np.nanmean(val_MmAP), np.nanmean(val_mAP)
-        val_MIoU, val_IoU = np.nanmean(val_MIoU), np.nanmean(val_IoU)
-        for cls, value in classes_MAP.items():
-            classes_MAP[cls] = np.divide(value[0], value[1])
+        metrics = val_metrics.compute()
+        val_MmAP, val_mAP = metrics["MmAP"], metrics["mAP"]
+        val_MIoU, val_IoU = metrics["MIoU"], metrics["IoU"]
+        classes_MAP, classes_AP = metrics["classes_MAP"], metrics["classes_AP"]
+        classes_IoU, classes_MIoU = metrics["classes_IoU"], metrics["classes_MIoU"]
         classes_MmAP_all= np.mean(np.array(list(classes_MAP.values())), axis=0)
-        for cls, value in classes_AP.items():
-            classes_AP[cls] = np.divide(value[0], value[1])
         classes_mAP_all= np.mean(np.array(list(classes_AP.values())), axis=0)
-        for cls, value in classes_IoU.items():
-            classes_IoU[cls] = np.divide(value[0], value[1])
         classes_IoU_all= np.mean(np.array(list(classes_IoU.values()))[:, :4], axis=0)
-        for cls, value in classes_MIoU.items():
-            classes_MIoU[cls] = np.divide(value[0], value[1])
         classes_MIoU_all= np.mean(np.array(list(classes_MIoU.values()))[:, :4], axis=0)
         
         if config.scheduler == 'LinearLR':
@@ -203,51 +222,45 @@ def train(model, num_epochs, batch_size, image_size, optimizer, criterion, sched
             log_file.write('Epoch {}/{}: Train loss: {:.4f} | Val loss: {:.4f} | lr: {:.4f} | mAP: {:.4f} | MmAP: {:.4f} | IoU: {:.4f} | MIoU: {:.4f}'.format(epoch + 1,num_epochs,train_loss/dl_lentrain,val_loss/dl_lenval,current_lr,classes_mAP_all,classes_MmAP_all,classes_IoU_all[0],classes_MIoU_all[0]))
 
         # Save model checkpoint every X epochs
+        checkpoint_metrics = {"val_loss": val_loss/dl_lenval, "MIoU": classes_MIoU_all[0], "best_loss": min(best_loss, float(val_loss/dl_lenval))}
         if epoch > 1 and epoch % 10 == 0 and phase == 'Valid':
-            torch.save(model, os.path.join(PATH_MODELS,'modelchp_{}_{}_{:3f}.pth'.format(wandb.run.name, epoch, classes_MIoU_all[0])))
-            print('Saving checkpoint as: modelchp_{}_{}_{:3f}.pth'.format(wandb.run.name, epoch, classes_MIoU_all[0]))
+            writer.save('modelchp_{}_{}_{:3f}'.format(run_name, epoch, classes_MIoU_all[0]), model, optimizer, scheduler, precision.scaler, epoch, checkpoint_metrics)
+            print('Saving checkpoint as: modelchp_{}_{}_{:3f}'.format(run_name, epoch, classes_MIoU_all[0]))
 
         # Save the best model based on validation loss
         if phase == 'Valid' and (val_loss/dl_lenval) < best_loss:
-            best_loss = (val_loss/dl_lenval)
-            best_model = copy.deepcopy(model.state_dict())
-            print('Saving model as the best so far: modelb_{}_{}_{:3f}.pth'.format(wandb.run.name, epoch, classes_MIoU_all[0]))
+            best_loss = float(val_loss/dl_lenval)
+            writer.save('modelb_{}_{}_{:3f}'.format(run_name, epoch, classes_MIoU_all[0]), model, optimizer, scheduler, precision.scaler, epoch, checkpoint_metrics, best=True, metric=best_loss)
+            print('Saving model as the best so far: modelb_{}_{}_{:3f}'.format(run_name, epoch, classes_MIoU_all[0]))
             
-        if WANDB:
-            normalized_results = upsampled_logits[0].softmax(dim=0).cpu().detach().numpy().squeeze()
-            id_map = np.argmax(normalized_results, axis=0).astype(np.uint8)
-            id_map = np.divide(id_map,np.max(id_map))
-
-            im_classes = []
-            for class_id in range(config.outs-1):
-                im_classes.append(wandb.Image((upsampled_logits[0][class_id].cpu()).detach().numpy(), caption="Prediction of a class {}".format(class_id+1)))
-            im_classes.append(wandb.Image((upsampled_logits[0][-1].cpu()).detach().numpy(), caption="Background"))
-            id_log = wandb.Image(id_map, caption="Predicted ID map")
-
-            mask_log = masks[0].cpu().detach().numpy() + 1
-            mask_log[mask_log==256] = 0
-            mask_log = (mask_log / config.outs)
-            mask_log = wandb.Image(mask_log, caption="Input mask")
-
-            wandb.log({
+        if logger.due(epoch):
+            # downsampled on the device, the logger writes them on its thread
+            images = segmentation_images(upsampled_logits, masks, config.outs, IMAGE_SIZE) if logger.images_due(epoch) else None
+            logger.log(epoch, {
                 "train_loss" : train_loss,
                 "val_loss" : val_loss,
                 "lr" : current_lr,
                 "mAP" : classes_mAP_all,
                 "MmAP" : classes_MmAP_all,
                 "IoU" : classes_IoU_all[0],
-                "MIoU" : classes_MIoU_all[0],
-                "Input, predicted mask, background" : [mask_log, id_log, im_classes[-1]],
-                "Classes": im_classes[0:-2]
-                })
+                "MIoU" : classes_MIoU_all[0]
+                }, images)
+
+        # the local sweep runner (scripts/sweep_runner.py) records the epoch and stops a pruned trial
+        if trial is not None and trial.report(epoch, classes_MIoU_all[0]):
+            print('Trial {} pruned after epoch {}'.format(run_name, epoch + 1))
+            if WANDB and wandb.run is not None:
+                wandb.run.summary["pruned_epoch"] = epoch + 1
+            break
 
+    writer.close()
+    logger.close()
     time_elapsed = time.time() - start
     print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
     print('Lowest Loss: {:4f}'.format(best_loss))
 
-    final_model = model
-    model.load_state_dict(best_model)
-    return final_model, model
+    # the final model and the path of the best checkpoint
+    return model, writer.best_path
 
 sweep_config = {
     'method': 'random',  # 'bayes', 'grid'
@@ -281,37 +294,57 @@ sweep_config = {
         },
         'outs': {
             'value': 13  # Fixed number of outputs
+        },
+        'precision': {
+            'value': 'fp32'  # fp32, amp, bf16 or fp16
+        },
+        'channels_last': {
+            'value': False
+        },
+        'accumulation_steps': {
+            'value': 1  # effective batch size batch_size * accumulation_steps
+        },
+        'activation_checkpointing': {
+            'value': False
         }
     }
 }
 
-def sweep_train():
-    with wandb.init() as run:
-        config = wandb.config
-        
-        model = create_model(config.outs)
-        
-        # Define optimizer
-        if config.optimizer == 'adam':
-            optimizer = Adam(model.parameters(), lr=config.learning_rate)
-        elif config.optimizer == 'adagrad':
-            optimizer = Adagrad(model.parameters(), lr=config.learning_rate)
-        elif config.optimizer == 'adamw':
-            optimizer = AdamW(model.parameters(), lr=config.learning_rate)
+def train_trial(config, run_name, trial=None):
+    model = create_model(config.outs)
+    
+    # Define optimizer
+    if config.optimizer == 'adam':
+        optimizer = Adam(model.parameters(), lr=config.learning_rate)
+    elif config.optimizer == 'adagrad':
+        optimizer = Adagrad(model.parameters(), lr=config.learning_rate)
+    elif config.optimizer == 'adamw':
+        optimizer = AdamW(model.parameters(), lr=config.learning_rate)
 
-        # Define scheduler
-        if config.scheduler == 'ReduceLROnPlateau':
-            scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=5, verbose=True, threshold=0.005, threshold_mode='abs')
-        elif config.scheduler == 'LinearLR':
-            scheduler = lr_scheduler.LinearLR(optimizer, start_factor=1.0, end_factor=0.5, total_iters=2)
-        
-        loss_function = nn.CrossEntropyLoss(ignore_index=255)
-        
-        model_final, best_model = train(model, config.epochs, config.batch_size, [config.image_size,config.image_size], optimizer, loss_function, scheduler, config)
-        
-        torch.save(model_final, os.path.join(PATH_MODELS, 'model_{}.pth'.format(wandb.run.name)))
-        torch.save(best_model, os.path.join(PATH_MODELS, 'modelb_{}.pth'.format(wandb.run.name)))
-        print('Saved as: model_{}.pth'.format(wandb.run.name))
+    # Define scheduler
+    if config.scheduler == 'ReduceLROnPlateau':
+        scheduler = lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=5, verbose=True, threshold=0.005, threshold_mode='abs')
+    elif config.scheduler == 'LinearLR':
+        scheduler = lr_scheduler.LinearLR(optimizer, start_factor=1.0, end_factor=0.5, total_iters=2)
+    
+    loss_function = nn.CrossEntropyLoss(ignore_index=255)
+    
+    model_final, best_path = train(model, config.epochs, config.batch_size, [config.image_size,config.image_size], optimizer, loss_function, scheduler, config, run_name, trial)
+    
+    path_final = save_checkpoint(os.path.join(PATH_MODELS, 'model_{}'.format(run_name)), model_final)
+    print('Saved as: {}, the best model as: {}'.format(path_final, best_path))
+
+def sweep_train(trial=None):
+    # a trial of the local sweep runner (sweep_local.py), a run of the wandb agent without a trial
+    if trial is not None:
+        return train_trial(trial.config, trial.name, trial)
+    with wandb.init() as run:
+        if PRUNER is None:
+            return train_trial(wandb.config, run.name)
+        # the partial results of a pruned run (learning curve, best MIoU, checkpoints) are kept
+        with agent_trial(PATH_SWEEPS, run.sweep_id or run.project, run.name, wandb.config, PRUNER, PRUNER_ARGS,
+                         sweep_config['metric']['goal'] == 'maximize') as trial:
+            train_trial(wandb.config, run.name, trial)
 
 if __name__ == "__main__":
         sweep_id = wandb.sweep(sweep_config, project="DP_train_full")
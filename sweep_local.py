@@ -0,0 +1,35 @@
+import os
+import json
+from scripts.sweep_runner import run_sweep
+
+PATH_SWEEPS = 'RailNet_DT/logs/sweeps.db'
+
+if __name__ == "__main__":
+    model_type = "segformer" #segformer or deeplab
+    sweep_name = 'segformer_local' # started again with the same name, an interrupted sweep continues
+    method = None # None keeps the method of sweep_config, or 'random', 'grid', 'bayes'
+    count = 10
+    num_workers = 1 # parallel trials, each in its own process
+    devices = None # GPUs assigned round-robin to the workers, e.g. ['0', '1']
+    pruner = 'asha' # 'asha', 'percentile', 'median' or None
+    pruner_args = {"min_epochs": 5, "reduction_factor": 3}
+    seed = 0
+    wandb_project = None # e.g. "DP_train_full" to log the trials to wandb as well
+
+    if model_type == 'segformer':
+        from sweep_SegFormer import sweep_config
+        module_name = 'sweep_SegFormer'
+    else:
+        from sweep_DeepLabv3 import sweep_config
+        module_name = 'sweep_DeepLabv3'
+    if method is not None:
+        sweep_config = dict(sweep_config, method=method)
+
+    os.makedirs(os.path.dirname(PATH_SWEEPS), exist_ok=True)
+    trials = run_sweep(sweep_config, module_name, PATH_SWEEPS, sweep_name, count, num_workers, pruner, pruner_args, seed, wandb_project, devices)
+
+    # best first, trials without a value last
+    sign = -1 if sweep_config['metric']['goal'] == 'maximize' else 1
+    for trial in sorted(trials, key=lambda trial: (trial["value"] is None, sign * (trial["value"] or 0))):
+        print('{} | {:9} | {}: {} | epochs: {} | {}'.format(trial["name"], trial["status"], sweep_config['metric']['name'],
+              '-' if trial["value"] is None else '{:.4f}'.format(trial["value"]), trial["epochs"], json.dumps(trial["config"])))
@@ -1,8 +1,15 @@
 from scripts.dataloader_SegFormer import CustomDataset
-from scripts.metrics_filtered_cls import compute_map_cls, compute_IoU
+from scripts.metrics_accumulator import MetricsAccumulator
+from scripts.data_loading import create_dataloader, set_epoch
+from scripts.inference_context import inference_context
+from scripts.mixed_precision import MixedPrecision
+from scripts.activation_checkpointing import enable_activation_checkpointing
+from scripts.checkpoints import CheckpointWriter, save_checkpoint
+from scripts.model_loading import load_weights
+from scripts.experiment_logging import ExperimentLogger, segmentation_images
+from scripts.distributed import setup_distributed, cleanup_distributed, get_device, is_main_process, wrap_model, sync_gradients, all_reduce_mean
 from transformers import SegformerModel, SegformerConfig, SegformerForSemanticSegmentation, SegformerImageProcessor
 from torch.optim import SGD, Adam, Adagrad, AdamW
-from torch.utils.data import DataLoader
 import torch.optim.lr_scheduler as lr_scheduler
 import torch.nn.functional as F
 import torch.nn as nn
@@ -14,7 +21,6 @@ import cv2
 import wandb
 from tqdm import tqdm
 import time
-import copy
 
 def get_image_4_wandb(path, input_size = [224,224]):
     transform_img = A.Compose([
@@ -55,6 +61,25 @@ else:
 
 PATH_MODELS = "RailNet_DT/models"
 PATH_LOGS = "RailNet_DT/logs"
+PATH_CACHE = None # pre-decoded Valid subset written by scripts/dataset_cache.py, e.g. "RailNet_DT/cache/rs19_val_light_1024x1024"
+# metrics are logged every LOG_INTERVAL epochs and images (downsampled to IMAGE_SIZE) every IMAGE_INTERVAL epochs,
+# on a background thread to PATH_LOGS/runs (JSONL + PNG, no network needed) and with WANDB to wandb as well
+LOG_INTERVAL = 1
+IMAGE_INTERVAL = 5
+IMAGE_SIZE = 256
+# DataLoader settings, num_workers=0 loads in the main process
+LOADER = {"num_workers": 4, "persistent_workers": True, "pin_memory": True, "prefetch_factor": 2}
+# training precision: fp32, amp (bf16 where supported, fp16 otherwise), bf16 or fp16, CHANNELS_LAST for the NHWC memory format
+PRECISION = 'fp32'
+CHANNELS_LAST = False
+# optimizer step every ACCUMULATION_STEPS batches (effective batch size batch_size * ACCUMULATION_STEPS), checkpointing of the encoder activations
+ACCUMULATION_STEPS = 1
+ACTIVATION_CHECKPOINTING = False
+# process group backend of a torchrun launch, None for nccl with GPUs and gloo on CPU (batch_size is per process)
+DISTRIBUTED_BACKEND = None
+# checkpoints are state dicts (SAFETENSORS for .safetensors weights), RESUME continues the run from its latest checkpoint
+SAFETENSORS = False
+RESUME = False
 
 
 def create_model(output_channels=1):
@@ -64,127 +89,139 @@ def create_model(output_channels=1):
 
     model.train()
     
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     model.to(device)
     
     return model
 
 def load_model(model_path):
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    # a checkpoint or .safetensors file of the run, rebuilt from the stored config
+    model = load_weights(model_path)
     model.train()
     
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    device = get_device()
     model.to(device)
     
     return model
 
 def train(model, num_epochs, batch_size, image_size, optimizer, criterion):
     start = time.time()
-    best_model = copy.deepcopy(model.state_dict())
     best_loss = 1e10
     loss = 0
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
-    for epoch in range(num_epochs):
-        print('-' * 20)
-        print('Epoch {}/{}'.format(epoch+1, num_epochs))
+    device = get_device()
+    precision = MixedPrecision(PRECISION, device, CHANNELS_LAST)
+    model = precision.prepare_model(model)
+    accumulation_steps = ACCUMULATION_STEPS
+    if ACTIVATION_CHECKPOINTING:
+        enable_activation_checkpointing(model)
+    main = is_main_process()
+
+    # written by rank 0 on a background thread, the run index keeps the latest and the best checkpoint by path
+    writer = CheckpointWriter(PATH_MODELS, 'run_{}_{}_{}'.format(num_epochs, lr, batch_size), SAFETENSORS, resume=RESUME)
+    logger = ExperimentLogger(os.path.join(PATH_LOGS, 'runs'), 'run_{}_{}_{}'.format(num_epochs, lr, batch_size), WANDB,
+                              LOG_INTERVAL, IMAGE_INTERVAL, IMAGE_SIZE) if main else None
+    start_epoch = 0
+    if RESUME and (checkpoint := writer.load_latest(model, optimizer, scheduler, precision.scaler)) is not None:
+        start_epoch, best_loss = checkpoint["epoch"] + 1, checkpoint["metrics"]["best_loss"]
+        if main:
+            print('Resuming from {} at epoch {}'.format(writer.index["latest"], start_epoch + 1))
+
+    # DistributedDataParallel for the training steps under torchrun, model itself otherwise
+    train_model = wrap_model(model, device)
+
+    # datasets and loaders are built once per run, the loader workers persist across the epochs
+    image_processor = SegformerImageProcessor(size={"height": 1024, "width": 1024})
+    dataloaders = {}
+    for phase in ['Train', 'Valid']:
+        dataset = CustomDataset(PATH_JPGS, PATH_MASKS, image_processor, image_size, subset=phase, val_fraction=0.5, cache_dir=PATH_CACHE)
+        dataloaders[phase] = create_dataloader(dataset, batch_size, shuffle=True, drop_last=True, **LOADER)
+
+    for epoch in range(start_epoch, num_epochs):
+        if main:
+            print('-' * 20)
+            print('Epoch {}/{}'.format(epoch+1, num_epochs))
         
         # Epoch
         train_loss = 0 # for the wandb logging
         val_loss = 0 # --||--
-        val_MmAP, val_mAP, val_IoU, val_MIoU = list(), list(), list(), list()
-        classes_MAP, classes_AP, classes_IoU, classes_MIoU = {},{},{},{}
+        val_metrics = MetricsAccumulator(outs, background=12, device=device) # accumulated on the device, synced once per epoch
         
         dl_lentrain = 0
         dl_lenval = 0
         
         for phase in ['Train', 'Valid']:
-
-            image_processor = SegformerImageProcessor(size={"height": 1024, "width": 1024})
-            dataset = CustomDataset(PATH_JPGS, PATH_MASKS, image_processor, image_size, subset=phase, val_fraction=0.5)
-            dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+            dataloader = dataloaders[phase]
+            set_epoch(dataloader, epoch)
             
             if phase == 'Train':
-                model.train()
+                train_model.train()
                 dl_lentrain = len(dataloader)
                 
-                for inputs, masks in tqdm(dataloader):
-                    inputs = inputs.to(device)
-                    masks = masks.to(device)
+                for step, (inputs, masks) in enumerate(tqdm(dataloader, disable=not main)):
+                    inputs = precision.prepare_inputs(inputs.to(device, non_blocking=True))
+                    masks = masks.to(device, non_blocking=True)
                     
-                    # zero the parameter gradients
-                    optimizer.zero_grad()
-
-                    outputs = model(inputs)
-                    logits = outputs.logits
+                    # zero the parameter gradients at the start of each accumulation window
+                    if step % accumulation_steps == 0:
+                        optimizer.zero_grad()
+
+                    # the gradients are all-reduced only in the backward pass of the optimizer step
+                    update = (step + 1) % accumulation_steps == 0 or step + 1 == dl_lentrain
+                    with sync_gradients(train_model, update):
+                        with precision.autocast():
+                            outputs = train_model(inputs)
+                            logits = outputs.logits
                     
-                    upsampled_logits = nn.functional.interpolate(
-                        logits,
-                        size=masks.shape[-2:],
-                        mode="bilinear",
-                        align_corners=False
-                    )
-
-                    upsampled_logits  = upsampled_logits.float()
+                            upsampled_logits = nn.functional.interpolate(
+                                logits,
+                                size=masks.shape[-2:],
+                                mode="bilinear",
+                                align_corners=False
+                            )
+
+                            upsampled_logits  = upsampled_logits.float()
                     
-                    loss = criterion(upsampled_logits, masks)
+                            loss = criterion(upsampled_logits, masks)
 
-                    loss.backward()  # gradients
-                    optimizer.step()  # update parameters
+                        precision.step(loss, optimizer, accumulation_steps, update)
 
                     train_loss += loss
                     
             elif phase == 'Valid':
                 model.eval()
                 dl_lenval = len(dataloader)
-                with torch.no_grad():
-                    for inputs, masks in tqdm(dataloader):
-                        inputs = inputs.to(device)
-                        masks = masks.to(device)
-
-                        outputs = model(inputs)
-                        logits = outputs.logits
+                with inference_context():
+                    for inputs, masks in tqdm(dataloader, disable=not main):
+                        inputs = precision.prepare_inputs(inputs.to(device, non_blocking=True))
+                        masks = masks.to(device, non_blocking=True)
+
+                        with precision.autocast():
+                            outputs = model(inputs)
+                            logits = outputs.logits
                         
-                        upsampled_logits = nn.functional.interpolate(
-                            logits,
-                            size=masks.shape[-2:],
-                            mode="bilinear",
-                            align_corners=False
-                        )
+                            upsampled_logits = nn.functional.interpolate(
+                                logits,
+                                size=masks.shape[-2:],
+                                mode="bilinear",
+                                align_corners=False
+                            )
 
-                        upsampled_logits  = upsampled_logits.float()
-                        loss = criterion(upsampled_logits, masks)
+                            upsampled_logits  = upsampled_logits.float()
+                            loss = criterion(upsampled_logits, masks)
 
                         val_loss += loss
-                        predicted_masks = upsampled_logits
-                        gt_masks = masks.cpu().detach().numpy().squeeze()
-                        for prediction, gt in zip(predicted_masks, gt_masks):
-                            prediction = F.softmax(prediction, dim=0).cpu().detach().numpy().squeeze()
-                            prediction = np.argmax(prediction, axis=0).astype(np.uint8)
-                            
-                            mAP,classes_AP = compute_map_cls(gt, prediction, classes_AP)
-                            Mmap,classes_MAP = compute_map_cls(gt, prediction, classes_MAP, major = True)
-                            IoU,_,_,_,classes_IoU = compute_IoU(gt, prediction, classes_IoU)
-                            MIoU,_,_,_,classes_MIoU = compute_IoU(gt, prediction, classes_MIoU, major=True)
-                            val_mAP.append(mAP)
-                            val_MmAP.append(Mmap)
-                            val_IoU.append(IoU)
-                            val_MIoU.append(MIoU)
-
-        # Compute the epoch mAP and IoU
-        val_MmAP, val_mAP = np.nanmean(val_MmAP), np.nanmean(val_mAP)
-        val_MIoU, val_IoU = np.nanmean(val_MIoU), np.nanmean(val_IoU)
-        for cls, value in classes_MAP.items():
-            classes_MAP[cls] = np.divide(value[0], value[1])
+                        val_metrics.update(upsampled_logits, masks)
+
+        # Compute the epoch losses, mAP and IoU over all processes
+        train_loss, val_loss = all_reduce_mean(train_loss, device), all_reduce_mean(val_loss, device)
+        metrics = val_metrics.compute()
+        val_MmAP, val_mAP = metrics["MmAP"], metrics["mAP"]
+        val_MIoU, val_IoU = metrics["MIoU"], metrics["IoU"]
+        classes_MAP, classes_AP = metrics["classes_MAP"], metrics["classes_AP"]
+        classes_IoU, classes_MIoU = metrics["classes_IoU"], metrics["classes_MIoU"]
         classes_MmAP_all= np.mean(np.array(list(classes_MAP.values())), axis=0)
-        for cls, value in classes_AP.items():
-            classes_AP[cls] = np.divide(value[0], value[1])
         classes_mAP_all= np.mean(np.array(list(classes_AP.values())), axis=0)
-        for cls, value in classes_IoU.items():
-            classes_IoU[cls] = np.divide(value[0], value[1])
         classes_IoU_all= np.mean(np.array(list(classes_IoU.values()))[:, :4], axis=0)
-        for cls, value in classes_MIoU.items():
-            classes_MIoU[cls] = np.divide(value[0], value[1])
         classes_MIoU_all= np.mean(np.array(list(classes_MIoU.values()))[:, :4], axis=0)
 
         # LROnPlateau
@@ -196,57 +233,48 @@ def train(model, num_epochs, batch_size, image_size, optimizer, criterion):
         current_lr = scheduler.get_last_lr()[0]
 
         # Print epoch summary
-        print('Epoch {}/{}: Train loss: {:.4f} | Val loss: {:.4f} | lr: {:.4f} | mAP: {:.4f} | MmAP: {:.4f} | IoU: {:.4f} | MIoU: {:.4f}'.format(epoch + 1,num_epochs,train_loss/dl_lentrain,val_loss/dl_lenval,current_lr,classes_mAP_all,classes_MmAP_all,classes_IoU_all[0],classes_MIoU_all[0]))
-        
-        with open(os.path.join(PATH_LOGS, 'log_{}_{}.txt'.format(num_epochs, lr)), 'a') as log_file:
-            log_file.write('Epoch {}/{}: Train loss: {:.4f} | Val loss: {:.4f} | lr: {:.4f} | mAP: {:.4f} | MmAP: {:.4f} | IoU: {:.4f} | MIoU: {:.4f}'.format(epoch + 1,num_epochs,train_loss/dl_lentrain,val_loss/dl_lenval,current_lr,classes_mAP_all,classes_MmAP_all,classes_IoU_all[0],classes_MIoU_all[0]))
+        if main:
+            print('Epoch {}/{}: Train loss: {:.4f} | Val loss: {:.4f} | lr: {:.4f} | mAP: {:.4f} | MmAP: {:.4f} | IoU: {:.4f} | MIoU: {:.4f}'.format(epoch + 1,num_epochs,train_loss/dl_lentrain,val_loss/dl_lenval,current_lr,classes_mAP_all,classes_MmAP_all,classes_IoU_all[0],classes_MIoU_all[0]))
+
+            with open(os.path.join(PATH_LOGS, 'log_{}_{}.txt'.format(num_epochs, lr)), 'a') as log_file:
+                log_file.write('Epoch {}/{}: Train loss: {:.4f} | Val loss: {:.4f} | lr: {:.4f} | mAP: {:.4f} | MmAP: {:.4f} | IoU: {:.4f} | MIoU: {:.4f}'.format(epoch + 1,num_epochs,train_loss/dl_lentrain,val_loss/dl_lenval,current_lr,classes_mAP_all,classes_MmAP_all,classes_IoU_all[0],classes_MIoU_all[0]))
 
         # Save model checkpoint every 5 epochs
-        if epoch > 1 and epoch % 5 == 0 and phase == 'Valid':
-            torch.save(model, os.path.join(PATH_MODELS,'modelchp_{}_{}_{}_{}_{:3f}.pth'.format(epoch, epochs, lr, batch_size,classes_MIoU_all[0])))
-            print('Saving checkpoint for epoch {} as: modelchp_{}_{}_{}_{}_{:3f}.pth'.format(epoch, epoch, epochs, lr, batch_size,classes_MIoU_all[0]))
+        checkpoint_metrics = {"val_loss": val_loss/dl_lenval, "MIoU": classes_MIoU_all[0], "best_loss": min(best_loss, float(val_loss/dl_lenval))}
+        if main and epoch > 1 and epoch % 5 == 0 and phase == 'Valid':
+            writer.save('modelchp_{}_{}_{}_{}_{:3f}'.format(epoch, epochs, lr, batch_size,classes_MIoU_all[0]), model, optimizer, scheduler, precision.scaler, epoch, checkpoint_metrics)
+            print('Saving checkpoint for epoch {} as: modelchp_{}_{}_{}_{}_{:3f}'.format(epoch, epoch, epochs, lr, batch_size,classes_MIoU_all[0]))
 
         # Save the best model based on validation loss
         if phase == 'Valid' and (val_loss/dl_lenval) < best_loss:
-            best_loss = (val_loss/dl_lenval)
-            best_model = copy.deepcopy(model.state_dict())
-            print('Saving model for epoch {} as the best so far: modelb_{}_{}_{}_{}_{:3f}.pth'.format(epoch, epoch, epochs, lr, batch_size,classes_MIoU_all[0]))
+            best_loss = float(val_loss/dl_lenval)
+            if main:
+                writer.save('modelb_{}_{}_{}_{}_{:3f}'.format(epoch, epochs, lr, batch_size,classes_MIoU_all[0]), model, optimizer, scheduler, precision.scaler, epoch, checkpoint_metrics, best=True, metric=best_loss)
+                print('Saving model for epoch {} as the best so far: modelb_{}_{}_{}_{}_{:3f}'.format(epoch, epoch, epochs, lr, batch_size,classes_MIoU_all[0]))
             
-        if WANDB:
-            normalized_results = upsampled_logits[0].softmax(dim=0).cpu().detach().numpy().squeeze()
-            id_map = np.argmax(normalized_results, axis=0).astype(np.uint8)
-            id_map = np.divide(id_map,np.max(id_map))
-
-            im_classes = []
-            for class_id in range(outs-1):
-                im_classes.append(wandb.Image((upsampled_logits[0][class_id].cpu()).detach().numpy(), caption="Prediction of a class {}".format(class_id+1)))
-            im_classes.append(wandb.Image((upsampled_logits[0][-1].cpu()).detach().numpy(), caption="Background"))
-            id_log = wandb.Image(id_map, caption="Predicted ID map")
-
-            mask_log = masks[0].cpu().detach().numpy() + 1
-            mask_log[mask_log==256] = 0
-            mask_log = (mask_log / outs)
-            mask_log = wandb.Image(mask_log, caption="Input mask")
-
-            wandb.log({
+        if main and logger.due(epoch):
+            # downsampled on the device, the logger writes them on its thread
+            images = segmentation_images(upsampled_logits, masks, outs, IMAGE_SIZE) if logger.images_due(epoch) else None
+            logger.log(epoch, {
                 "train_loss" : train_loss,
                 "val_loss" : val_loss,
                 "lr" : current_lr,
                 "mAP" : classes_mAP_all,
                 "MmAP" : classes_MmAP_all,
                 "IoU" : classes_IoU_all[0],
-                "MIoU" : classes_MIoU_all[0],
-                "Input, predicted mask, background" : [mask_log, id_log, im_classes[-1]],
-                "Classes": im_classes[0:-2]
-                })
+                "MIoU" : classes_MIoU_all[0]
+                }, images)
 
+    writer.close()
+    if main:
+        logger.close()
     time_elapsed = time.time() - start
-    print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
-    print('Lowest Loss: {:4f}'.format(best_loss))
+    if main:
+        print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
+        print('Lowest Loss: {:4f}'.format(best_loss))
 
-    final_model = model
-    model.load_state_dict(best_model)
-    return final_model, model
+    # the final model and the path of the best checkpoint
+    return model, writer.best_path
 
 if __name__ == "__main__":
     epochs = 150
@@ -254,6 +282,8 @@ if __name__ == "__main__":
     batch_size = 4
     outs = 13
     image_size = [1024,1024]
+    # started by torchrun (torchrun --nproc_per_node=N train_SegFormer.py) every process trains on its part of the data
+    setup_distributed(DISTRIBUTED_BACKEND)
     
     model = create_model(outs)
     #model = load_model('RailNet_DT/models/modelchp_105_300_0.001_32.pth')
@@ -264,13 +294,14 @@ if __name__ == "__main__":
                                                 #threshold=0.005, threshold_mode='abs')
     scheduler = lr_scheduler.LinearLR(optimizer, start_factor=1.0, end_factor=0.5, total_iters=30)
 
-    if WANDB:
+    if WANDB and is_main_process():
         wandb_init(epochs, lr, batch_size, outs, str(optimizer.__class__), str(scheduler.__class__), str(model.__class__))
 
-    model_final, best_model = train(model, epochs, batch_size, image_size, optimizer, loss_function)
+    model_final, best_path = train(model, epochs, batch_size, image_size, optimizer, loss_function)
 
-    torch.save(model_final, os.path.join(PATH_MODELS, 'model_{}_{}_{}_{}.pth'.format(epochs, lr, outs, batch_size)))
-    torch.save(best_model, os.path.join(PATH_MODELS, 'modelb_{}_{}_{}_{}.pth'.format(epochs, lr, outs, batch_size)))
-    print('Saved as: model_{}_{}_{}_{}.pth'.format(epochs, lr, outs, batch_size))
-    if WANDB:
-        wandb.finish()
\ No newline at end of file
+    if is_main_process():
+        path_final = save_checkpoint(os.path.join(PATH_MODELS, 'model_{}_{}_{}_{}'.format(epochs, lr, outs, batch_size)), model_final, SAFETENSORS)
+        print('Saved as: {}, the best model as: {}'.format(path_final, best_path))
+    if WANDB and is_main_process():
+        wandb.finish()
+    cleanup_distributed()
\ No newline at end of file